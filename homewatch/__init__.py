@@ -7,6 +7,7 @@ import pathlib
 from .library import Library
 from .server import runserver
 from .settings import Settings
+from .snapshot import write_library_snapshot
 
 
 def setup_logging(verbose: bool = False):
@@ -58,6 +59,8 @@ def main():
     parser_scan.add_argument("root", type=str)
     parser_scan.add_argument("--clear", action="store_true")
     parser_scan.add_argument("--output", type=str, default=None)
+    parser_scan.add_argument("-j", "--jobs", type=int, default=None)
+    parser_scan.add_argument("--full", action="store_true")
     parser_runserver = subparsers.add_parser("runserver")
     parser_runserver.add_argument("-d", "--debug", action="store_true")
     parser_runserver.add_argument("-q", "--qrcode", action="store_true")
@@ -72,7 +75,11 @@ def main():
                 Library.clear_hidden_directories(root, settings.hidden_directory)
                 return
             settings.library_root = root.as_posix()
-            library = Library.from_scan(settings)
+            if args.jobs is not None:
+                settings.scan_jobs = max(1, args.jobs)
+            library = Library.from_scan(settings, incremental=not args.full)
+            if settings.library_snapshot_path is not None:
+                write_library_snapshot(library, settings.library_snapshot_path)
             if args.output is not None:
                 with open(args.output, "w", encoding="utf8") as file:
                     json.dump(library.to_dict(), file, indent=4)
@@ -0,0 +1,425 @@
+"""HTTP and websocket server running on a single asyncio event loop.
+
+Requests are parsed on the loop and passed to the WSGI application in a thread
+pool, so that blocking library or VLC calls do not stall other connections.
+Files sent through `wsgi.file_wrapper` are transferred with `loop.sendfile`.
+Websocket connections are accepted on the same port, at `WEBSOCKET_PATH`, and
+driven by the sans-I/O protocol of the websockets library.
+"""
+
+import asyncio
+import concurrent.futures
+import io
+import logging
+import sys
+import urllib.parse
+import wsgiref.handlers
+from typing import BinaryIO, Callable, Iterable, Protocol
+
+import websockets.frames
+import websockets.protocol
+import websockets.server
+
+from .settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+
+WEBSOCKET_PATH = "/ws"
+MAX_HEADER_BYTES = 64 * 1024
+# Request bodies are read in memory, and the API only receives small ones
+MAX_BODY_BYTES = 1024 * 1024
+KEEPALIVE_TIMEOUT_SECONDS = 75
+READ_SIZE = 64 * 1024
+
+# Broadcasts to clients that do not read their messages are dropped instead
+# of being buffered indefinitely
+MAX_WEBSOCKET_BUFFER_BYTES = 1024 * 1024
+
+
+class FileWrapper:
+    """Implementation of `wsgi.file_wrapper`. Responses made of a wrapped file
+    are sent with `loop.sendfile`, starting at the current position of the
+    file, for the length given by the Content-Length header.
+    """
+
+    def __init__(self, file: BinaryIO, block_size: int = 8192):
+        self.file = file
+        self.block_size = block_size
+
+    def __iter__(self):
+        while True:
+            data = self.file.read(self.block_size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self.file.close()
+
+
+class ClosingIterator:
+    """Iterator over the remaining chunks of a response, closing the original
+    response iterable when closed.
+    """
+
+    def __init__(self, iterator, app_iter):
+        self.iterator = iterator
+        self.app_iter = app_iter
+
+    def __iter__(self):
+        return self.iterator
+
+    def close(self):
+        if hasattr(self.app_iter, "close"):
+            self.app_iter.close()
+
+
+class WebsocketConnection:
+    """Websocket client connected to the asyncio server. Its methods must be
+    called from the event loop.
+    """
+
+    def __init__(self, protocol: websockets.server.ServerProtocol, writer: asyncio.StreamWriter):
+        self.protocol = protocol
+        self.writer = writer
+        self.remote_address: tuple[str, int] = writer.get_extra_info("peername")[:2]
+
+    def send(self, message: str):
+        if self.protocol.state is not websockets.protocol.State.OPEN:
+            return
+        if self.writer.transport.get_write_buffer_size() > MAX_WEBSOCKET_BUFFER_BYTES:
+            logger.debug("Skipped message to %s:%d, client is too slow", *self.remote_address)
+            return
+        self.protocol.send_text(message.encode("utf8"))
+        self.flush()
+
+    def flush(self):
+        for data in self.protocol.data_to_send():
+            if data:
+                self.writer.write(data)
+            elif self.writer.can_write_eof():
+                self.writer.write_eof()
+
+
+class WebsocketHandler(Protocol):
+
+    def attach(self, loop: asyncio.AbstractEventLoop): ...
+
+    def add_client(self, conn: WebsocketConnection): ...
+
+    def remove_client(self, conn: WebsocketConnection): ...
+
+    def handle_message(self, conn: WebsocketConnection, message: str): ...
+
+
+def parse_request_head(head: bytes) -> tuple[str, str, str, list[tuple[str, str]]]:
+    """Return the method, target, version and headers (with lowercase names)
+    of a request. Raise a ValueError if it is malformed.
+    """
+    lines = head.decode("latin-1").split("\r\n")
+    method, target, version = lines[0].split(" ")
+    if not version.startswith("HTTP/1."):
+        raise ValueError(f"Unsupported protocol version {version}")
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(":")
+        if not sep or not name or name != name.strip():
+            raise ValueError(f"Invalid header line {line!r}")
+        headers.append((name.lower(), value.strip()))
+    return method, target, version, headers
+
+
+def next_chunk(iterator) -> bytes | None:
+    return next(iterator, None)
+
+
+class AsyncioServer:
+
+    def __init__(self, app: Callable, settings: Settings, websocket_handler: WebsocketHandler | None = None):
+        self.app = app
+        self.host = settings.server_host
+        self.port = settings.server_port
+        self.websocket_handler = websocket_handler
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=settings.server_workers,
+            thread_name_prefix="http")
+        self._stop_event: asyncio.Event | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.info("Interrupted")
+
+    def stop(self):
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        if self.websocket_handler is not None:
+            self.websocket_handler.attach(self._loop)
+        server = await asyncio.start_server(self._handle_connection, self.host, self.port, limit=MAX_HEADER_BYTES)
+        logger.info("Started asyncio server at http://%s:%d", self.host, self.port)
+        try:
+            async with server:
+                await self._stop_event.wait()
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            logger.info("Asyncio server is closed")
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info("peername")
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    async with asyncio.timeout(KEEPALIVE_TIMEOUT_SECONDS):
+                        head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, TimeoutError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._send_error(writer, "431 Request Header Fields Too Large")
+                    break
+                try:
+                    method, target, version, headers = parse_request_head(head)
+                except ValueError as err:
+                    logger.debug("Bad request from %s: %s", peer, err)
+                    await self._send_error(writer, "400 Bad Request")
+                    break
+                if target.split("?")[0] == WEBSOCKET_PATH\
+                        and self.websocket_handler is not None\
+                        and any(name == "upgrade" and value.lower() == "websocket" for name, value in headers):
+                    await self._handle_websocket(head, reader, writer)
+                    break
+                keep_alive = await self._handle_http(method, target, version, headers, reader, writer, peer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            logger.exception("Error while handling connection from %s", peer)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _send_error(self, writer: asyncio.StreamWriter, status: str):
+        body = status.encode("latin-1")
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+            + body)
+        await writer.drain()
+
+    def _build_environ(self, method: str, target: str, version: str, headers: list[tuple[str, str]], body: bytes, peer: tuple) -> dict:
+        if not target.startswith("/"):
+            # Absolute-form target, as sent to proxies
+            split = urllib.parse.urlsplit(target)
+            target = split.path + ("?" + split.query if split.query else "")
+        path, _, query = target.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.parse.unquote_to_bytes(path).decode("latin-1"),
+            "QUERY_STRING": query,
+            "REQUEST_URI": target,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": peer[0],
+            "REMOTE_PORT": str(peer[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": FileWrapper,
+        }
+        for name, value in headers:
+            if "_" in name:
+                # Could be mistaken for another header once converted
+                continue
+            key = name.upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+            if key in environ:
+                environ[key] += "," + value
+            else:
+                environ[key] = value
+        return environ
+
+    def _call_app(self, environ: dict) -> tuple[str, list[tuple[str, str]], list[bytes], Iterable[bytes] | None, bytes | None]:
+        """Call the application, in a worker thread. Return the status, the
+        headers, the data passed to `write`, the response iterable and its
+        first chunk, fetched here as most responses are made of a single one.
+        """
+        response: list = []
+        written: list[bytes] = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [status, headers]
+            return written.append
+
+        try:
+            app_iter = self.app(environ, start_response)
+            first = None
+            if not isinstance(app_iter, FileWrapper):
+                iterator = iter(app_iter)
+                first = next_chunk(iterator)
+                app_iter = ClosingIterator(iterator, app_iter)
+        except Exception:
+            logger.exception("Error while handling %s %s", environ["REQUEST_METHOD"], environ["PATH_INFO"])
+            body = b"500 Internal Server Error"
+            return "500 Internal Server Error", [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))], [], None, body
+        status, headers = response
+        return status, headers, written, app_iter, first
+
+    async def _handle_http(self, method: str, target: str, version: str, headers: list[tuple[str, str]],
+                           reader: asyncio.StreamReader, writer: asyncio.StreamWriter, peer: tuple) -> bool:
+        """Handle a request, and return whether the connection can be reused.
+        """
+        assert self._loop is not None
+        header_map: dict[str, str] = {}
+        for name, value in headers:
+            header_map[name] = header_map[name] + "," + value if name in header_map else value
+        connection = header_map.get("connection", "").lower()
+        keep_alive = "close" not in connection and (version == "HTTP/1.1" or "keep-alive" in connection)
+        if "transfer-encoding" in header_map:
+            await self._send_error(writer, "411 Length Required")
+            return False
+        try:
+            length = int(header_map.get("content-length", "0"))
+        except ValueError:
+            await self._send_error(writer, "400 Bad Request")
+            return False
+        if length < 0:
+            await self._send_error(writer, "400 Bad Request")
+            return False
+        if length > MAX_BODY_BYTES:
+            await self._send_error(writer, "413 Content Too Large")
+            return False
+        if header_map.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        body = await reader.readexactly(length) if length > 0 else b""
+        environ = self._build_environ(method, target, version, headers, body, peer)
+        status, response_headers, written, app_iter, first = await self._loop.run_in_executor(self.executor, self._call_app, environ)
+        try:
+            return await self._send_response(writer, method, version, keep_alive, status, response_headers, written, app_iter, first)
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close() # type: ignore
+
+    async def _send_response(self, writer: asyncio.StreamWriter, method: str, version: str, keep_alive: bool,
+                             status: str, headers: list[tuple[str, str]], written: list[bytes],
+                             app_iter: Iterable[bytes] | None, first: bytes | None) -> bool:
+        assert self._loop is not None
+        code = int(status.split(" ", 1)[0])
+        content_length = None
+        out_headers = []
+        for name, value in headers:
+            lname = name.lower()
+            if lname == "content-length":
+                content_length = int(value)
+            elif lname in ("connection", "keep-alive", "transfer-encoding"):
+                continue
+            out_headers.append((name, value))
+        has_body = method != "HEAD" and code >= 200 and code not in (204, 304)
+        chunked = has_body and content_length is None and version == "HTTP/1.1"
+        if has_body and content_length is None and not chunked:
+            # The end of the body can only be marked by closing the connection
+            keep_alive = False
+        if chunked:
+            out_headers.append(("Transfer-Encoding", "chunked"))
+        if not any(name.lower() == "date" for name, _ in out_headers):
+            out_headers.append(("Date", wsgiref.handlers.format_date_time(None)))
+        out_headers.append(("Connection", "keep-alive" if keep_alive else "close"))
+        head = f"HTTP/1.1 {status}\r\n" + "".join(f"{name}: {value}\r\n" for name, value in out_headers) + "\r\n"
+        writer.write(head.encode("latin-1"))
+        if not has_body:
+            await writer.drain()
+            return keep_alive
+        if isinstance(app_iter, FileWrapper) and content_length is not None and not written:
+            await writer.drain()
+            offset = app_iter.file.tell()
+            await self._loop.sendfile(writer.transport, app_iter.file, offset, content_length)
+            return keep_alive
+        remaining = content_length
+        iterator = iter(app_iter) if app_iter is not None else iter(())
+        chunks: list[bytes] = written + ([first] if first is not None else [])
+        while remaining is None or remaining > 0:
+            if chunks:
+                chunk = chunks.pop(0)
+            else:
+                chunk = await self._loop.run_in_executor(self.executor, next_chunk, iterator)
+                if chunk is None:
+                    break
+            if not chunk:
+                continue
+            if remaining is not None:
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+            writer.write(b"%x\r\n%b\r\n" % (len(chunk), chunk) if chunked else chunk)
+            await writer.drain()
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return keep_alive and not remaining
+
+    async def _handle_websocket(self, head: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        assert self._loop is not None and self.websocket_handler is not None
+        protocol = websockets.server.ServerProtocol()
+        protocol.receive_data(head)
+        request = protocol.events_received()[0]
+        protocol.send_response(protocol.accept(request)) # type: ignore
+        conn = WebsocketConnection(protocol, writer)
+        conn.flush()
+        await writer.drain()
+        if protocol.state is not websockets.protocol.State.OPEN:
+            return
+        logger.debug("New client %s:%d", *conn.remote_address)
+        self.websocket_handler.add_client(conn)
+        fragments: list[bytes] | None = None
+        try:
+            while protocol.state is not websockets.protocol.State.CLOSED:
+                data = await reader.read(READ_SIZE)
+                if data:
+                    protocol.receive_data(data)
+                else:
+                    protocol.receive_eof()
+                conn.flush()
+                await writer.drain()
+                for event in protocol.events_received():
+                    if not isinstance(event, websockets.frames.Frame):
+                        continue
+                    if event.opcode is websockets.frames.Opcode.TEXT:
+                        fragments = [event.data]
+                    elif event.opcode is websockets.frames.Opcode.CONT and fragments is not None:
+                        fragments.append(event.data)
+                    else:
+                        fragments = None
+                        continue
+                    if not event.fin:
+                        continue
+                    message = b"".join(fragments).decode("utf8")
+                    fragments = None
+                    try:
+                        # Messages from a client are handled in order
+                        await self._loop.run_in_executor(self.executor, self.websocket_handler.handle_message, conn, message)
+                    except Exception:
+                        logger.exception("Error while handling websocket message %r", message)
+                if not data:
+                    break
+        finally:
+            logger.debug("Client %s:%d disconnected", *conn.remote_address)
+            self.websocket_handler.remove_client(conn)
+
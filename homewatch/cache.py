@@ -0,0 +1,225 @@
+"""In-memory caches of the library, for the library server.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import pathlib
+import threading
+import time
+from typing import Iterator
+
+from .library import DirectoryListing, Hierarchy, Library, LibraryFolder, walk_library
+from .settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class LibraryFolderCache:
+    """Bounded LRU cache of library folders. Entries are only returned while
+    the fingerprint of their directory is unchanged, and for at most
+    `ttl_seconds` after they were scanned.
+    """
+
+    def __init__(self, size: int, ttl_seconds: float):
+        self.size = size
+        self.ttl_seconds = ttl_seconds
+        self._entries: collections.OrderedDict[str, tuple[str, float, LibraryFolder]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, fingerprint: str) -> tuple[LibraryFolder | None, LibraryFolder | None]:
+        """Return the cached folder at `key` if it is still valid, otherwise
+        None along with the stale folder, if any, whose medias can be reused.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, None
+            entry_fingerprint, scanned_at, folder = entry
+            if entry_fingerprint != fingerprint or time.monotonic() - scanned_at > self.ttl_seconds:
+                self.misses += 1
+                del self._entries[key]
+                return None, folder
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return folder, None
+
+    def put(self, key: str, fingerprint: str, folder: LibraryFolder):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (fingerprint, time.monotonic(), folder)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "capacity": self.size,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / requests if requests else None,
+            }
+
+
+class HierarchyCache:
+    """Hierarchy of the library kept in memory along with the listing of each
+    directory, and served as precomputed JSON. Changed directories are listed
+    again and patched in, either when they are reported by a library watcher,
+    or when their modification time changed since the last revalidation.
+    """
+
+    def __init__(self, settings: Settings, watched: bool = False):
+        self.settings = settings
+        self.root = pathlib.Path(settings.library_root)
+        self.watched = watched
+        self._listings: dict[str, DirectoryListing] = {}
+        self._lock = threading.Lock()
+        self._checked_at: float = 0
+        self._dirty: set[str] = set()
+        self.body: bytes = b""
+        self.etag: str = ""
+
+    def get(self) -> tuple[bytes, str]:
+        """Return the JSON body of the hierarchy, and its ETag.
+        """
+        with self._lock:
+            if not self._listings:
+                logger.info("Exploring hierarchy at %s", self.root)
+                self._add_subtree(pathlib.Path("."))
+                self._build()
+            elif self._dirty:
+                self._patch(self._dirty)
+                self._dirty = set()
+            elif not self.watched and time.monotonic() - self._checked_at > self.settings.hierarchy_cache_ttl_seconds:
+                self._revalidate()
+            return self.body, self.etag
+
+    def invalidate(self, keys: set[str]):
+        """Mark directories (paths relative to the library root) as changed.
+        They are listed again on the next request.
+        """
+        with self._lock:
+            self._dirty.update(keys)
+
+    def _add_subtree(self, top: pathlib.Path):
+        for listing in walk_library(self.root, self.settings.hidden_directory, top):
+            self._listings[listing.path.as_posix()] = listing
+
+    def _remove_subtree(self, key: str):
+        prefix = key + "/" if key != "." else ""
+        for other in [k for k in self._listings if k == key or k.startswith(prefix)]:
+            del self._listings[other]
+
+    def _revalidate(self):
+        changed = set()
+        for key, listing in self._listings.items():
+            try:
+                mtime_ns = (self.root / listing.path).stat().st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            if mtime_ns != listing.mtime_ns:
+                changed.add(key)
+        self._checked_at = time.monotonic()
+        if changed:
+            self._patch(changed)
+
+    def _patch(self, keys: set[str]):
+        logger.info("Updating hierarchy for %d changed directories", len(keys))
+        # Parents first, so that new subfolders are only explored once
+        for key in sorted(keys, key=lambda k: (k.count("/"), k)):
+            path = pathlib.Path(key)
+            if not (self.root / path).is_dir():
+                self._remove_subtree(key)
+                continue
+            previous = self._listings.get(key)
+            if previous is None:
+                if key == "." or path.parent.as_posix() in self._listings:
+                    self._add_subtree(path)
+                continue
+            listing = DirectoryListing.from_scan(self.root, path, self.settings.hidden_directory)
+            self._listings[key] = listing
+            for dirname in set(previous.dirs) - set(listing.dirs):
+                self._remove_subtree((path / dirname).as_posix())
+            for dirname in listing.dirs:
+                if (path / dirname).as_posix() not in self._listings:
+                    self._add_subtree(path / dirname)
+        self._build()
+
+    def _iter_listings(self) -> Iterator[DirectoryListing]:
+        """Iterate over the listings in the order of `walk_library`.
+        """
+        stack = [pathlib.Path(".")]
+        while stack:
+            listing = self._listings.get(stack.pop().as_posix())
+            if listing is None:
+                continue
+            yield listing
+            stack.extend(listing.path / dirname for dirname in reversed(listing.dirs))
+
+    def _build(self):
+        hierarchy = Hierarchy.from_listings(self.settings, self.root, self._iter_listings())
+        self.body = json.dumps(hierarchy.to_dict()).encode("utf8")
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        self._checked_at = time.monotonic()
+
+
+class LibraryCache:
+    """Whole library kept in memory for bulk downloads. Changed folders are
+    scanned again and patched in, either when they are reported by a library
+    watcher, or when their fingerprint changed since the last revalidation.
+    """
+
+    def __init__(self, settings: Settings, watched: bool = False):
+        self.settings = settings
+        self.root = pathlib.Path(settings.library_root)
+        self.watched = watched
+        self.library: Library | None = None
+        self._lock = threading.Lock()
+        self._checked_at: float = 0
+        self._dirty: set[str] = set()
+
+    def get(self) -> Library:
+        with self._lock:
+            if self.library is None:
+                self.library = Library.from_scan(self.settings)
+                self._checked_at = time.monotonic()
+            elif self._dirty:
+                self.library = self.library.refresh_folders(self._dirty)
+                self._dirty = set()
+            elif not self.watched and time.monotonic() - self._checked_at > self.settings.hierarchy_cache_ttl_seconds:
+                self._revalidate()
+            return self.library
+
+    def invalidate(self, keys: set[str]):
+        """Mark folders (paths relative to the library root) as changed. They
+        are scanned again on the next request.
+        """
+        with self._lock:
+            if self.library is not None:
+                self._dirty.update(keys)
+
+    def _revalidate(self):
+        assert self.library is not None
+        fingerprints = {
+            listing.path.as_posix(): listing.fingerprint
+            for listing in walk_library(self.root, self.settings.hidden_directory)
+        }
+        changed = {key for key, fingerprint in fingerprints.items() if key not in self.library or self.library[key].fingerprint != fingerprint}
+        changed.update(key for key in self.library if key not in fingerprints)
+        self._checked_at = time.monotonic()
+        if changed:
+            logger.info("Updating library for %d changed folders", len(changed))
+            self.library = self.library.refresh_folders(changed)
@@ -0,0 +1,189 @@
+"""Negotiated compression of HTTP responses.
+
+Dynamic responses are compressed on the fly when they are large enough, while
+static files are compressed once at startup and served from memory. Brotli is
+used if the 'brotli' package is installed and the client accepts it, gzip
+otherwise.
+"""
+
+import datetime
+import gzip
+import hashlib
+import logging
+import mimetypes
+import pathlib
+import urllib.parse
+from typing import Callable, Iterable
+
+import werkzeug
+import werkzeug.datastructures
+import werkzeug.http
+
+from .settings import Settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+logger = logging.getLogger(__name__)
+
+
+COMPRESSIBLE_MIMETYPES = {
+    "application/javascript",
+    "application/json",
+    "image/svg+xml",
+    "text/css",
+    "text/html",
+    "text/javascript",
+    "text/plain",
+}
+
+STATIC_MAX_AGE_SECONDS = 43200
+
+
+def get_supported_encodings() -> list[str]:
+    """Return the supported content encodings, by order of preference.
+    """
+    if brotli is None:
+        return ["gzip"]
+    return ["br", "gzip"]
+
+
+def negotiate_encoding(accept_encoding: str, encodings: list[str]) -> str | None:
+    """Return the preferred encoding among `encodings` accepted by the client
+    according to its Accept-Encoding header, or None.
+    """
+    accept = werkzeug.http.parse_accept_header(accept_encoding)
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = accept[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data: bytes, encoding: str, level: int = 6) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=min(level, 11)) # type: ignore
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def is_compressible(content_type: str | None) -> bool:
+    if not content_type:
+        return False
+    return content_type.split(";")[0].strip().lower() in COMPRESSIBLE_MIMETYPES
+
+
+class StaticFile:
+
+    def __init__(self, path: pathlib.Path, encodings: list[str]):
+        data = path.read_bytes()
+        self.mimetype = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        self.etag = hashlib.sha1(data).hexdigest()
+        self.last_modified = datetime.datetime.fromtimestamp(int(path.stat().st_mtime), datetime.timezone.utc)
+        # Static files are compressed with the highest level, as it is done
+        # only once
+        self.variants: dict[str, bytes] = {}
+        for encoding in encodings:
+            compressed = compress(data, encoding, 11 if encoding == "br" else 9)
+            if len(compressed) < len(data):
+                self.variants[encoding] = compressed
+
+
+def get_static_prefix(settings: Settings) -> str:
+    """Return the path under which static files are served, from the static
+    URL setting.
+    """
+    path = urllib.parse.urlparse(settings.static_url).path
+    return path if path.endswith("/") else path + "/"
+
+
+class CompressionMiddleware:
+    """WSGI middleware compressing responses, and serving pre-compressed static
+    files from `static_directory` under the static URL path. Other static
+    requests, such as the ones from clients not accepting any encoding, are
+    passed to the wrapped application. If `static_directory` is None, static
+    files are not served by the application, and are left alone.
+    """
+
+    def __init__(self, app: Callable, settings: Settings, static_directory: pathlib.Path | None = None):
+        self.app = app
+        self.min_size = settings.compression_min_bytes
+        self.encodings = get_supported_encodings()
+        self.static_prefix = get_static_prefix(settings)
+        self.static_files: dict[str, StaticFile] = {}
+        if static_directory is None:
+            return
+        for path in static_directory.rglob("*"):
+            if path.is_file() and is_compressible(mimetypes.guess_type(path.name)[0]):
+                static_file = StaticFile(path, self.encodings)
+                if static_file.variants:
+                    self.static_files[self.static_prefix + path.relative_to(static_directory).as_posix()] = static_file
+        logger.info("Pre-compressed %d static files with %s", len(self.static_files), ", ".join(self.encodings))
+
+    def __call__(self, environ, start_response) -> Iterable[bytes]:
+        encoding = negotiate_encoding(environ.get("HTTP_ACCEPT_ENCODING", ""), self.encodings)
+        if encoding is None or environ.get("REQUEST_METHOD") not in ("GET", "POST"):
+            return self.app(environ, start_response)
+        static_file = self.static_files.get(environ.get("PATH_INFO", ""))
+        if static_file is not None and encoding in static_file.variants:
+            return self._serve_static(environ, start_response, static_file, encoding)
+        return self._serve_dynamic(environ, start_response, encoding)
+
+    def _serve_static(self, environ, start_response, static_file: StaticFile, encoding: str) -> Iterable[bytes]:
+        etag = f"{static_file.etag}-{encoding}"
+        if not werkzeug.http.is_resource_modified(environ, etag=etag, last_modified=static_file.last_modified):
+            response = werkzeug.Response(status=304)
+        else:
+            response = werkzeug.Response(static_file.variants[encoding], status=200, mimetype=static_file.mimetype)
+            response.headers["Content-Encoding"] = encoding
+            response.last_modified = static_file.last_modified
+        response.set_etag(etag)
+        response.vary.add("Accept-Encoding")
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE_SECONDS
+        return response(environ, start_response)
+
+    def _is_compressible_response(self, status: str, headers: werkzeug.datastructures.Headers) -> bool:
+        return status.startswith("200")\
+            and "Content-Encoding" not in headers\
+            and is_compressible(headers.get("Content-Type"))
+
+    def _serve_dynamic(self, environ, start_response, encoding: str) -> Iterable[bytes]:
+        captured = []
+        # Data passed to the `write` callable by applications whose response
+        # is compressed
+        written: list[bytes] = []
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured[:] = [status, werkzeug.datastructures.Headers(headers), exc_info]
+            if not self._is_compressible_response(status, captured[1]):
+                # Passed through as is
+                captured.clear()
+                return start_response(status, headers, exc_info)
+            return written.append
+
+        app_iter = self.app(environ, capture_start_response)
+        if not captured:
+            return app_iter
+        status, headers, exc_info = captured
+        try:
+            body = b"".join(written) + b"".join(app_iter)
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close() # type: ignore
+        if "Accept-Encoding" not in headers.get("Vary", ""):
+            headers.add("Vary", "Accept-Encoding")
+        if len(body) >= self.min_size:
+            body = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+            etag = headers.get("ETag")
+            if etag is not None and not etag.startswith("W/"):
+                # The compressed body is a different representation, but it
+                # is semantically equivalent
+                headers["ETag"] = "W/" + etag
+        headers["Content-Length"] = str(len(body))
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return [body]
@@ -0,0 +1,58 @@
+"""Delivery of player events outside of the VLC event thread.
+
+libvlc calls event callbacks from its own thread, which must not be held up by
+observers: callbacks only publish events to a bus, and a dispatcher thread
+handles them in order. Consecutive events of coalesced kinds (such as time
+changes piling up while an observer is slow) are merged, keeping only the
+latest value.
+"""
+
+import collections
+import logging
+import threading
+from typing import Any, Callable
+
+
+logger = logging.getLogger(__name__)
+
+
+class EventBus(threading.Thread):
+
+    def __init__(self, handler: Callable[[str, Any], None], coalesced_kinds: set[str] = set()):
+        threading.Thread.__init__(self, daemon=True, name="player-events")
+        self.handler = handler
+        self.coalesced_kinds = coalesced_kinds
+        self._events: collections.deque[tuple[str, Any]] = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self.coalesced = 0
+
+    def publish(self, kind: str, value: Any = None):
+        with self._condition:
+            if kind in self.coalesced_kinds and self._events and self._events[-1][0] == kind:
+                self._events[-1] = (kind, value)
+                self.coalesced += 1
+            else:
+                self._events.append((kind, value))
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._events and not self._closed:
+                    self._condition.wait()
+                if not self._events:
+                    break
+                kind, value = self._events.popleft()
+            try:
+                self.handler(kind, value)
+            except Exception:
+                logger.exception("Error while handling %s event", kind)
+        logger.debug("Event bus is closed, %d events were coalesced", self.coalesced)
+
+    def close(self):
+        """Stop the dispatcher once the pending events are handled.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
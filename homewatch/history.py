@@ -2,20 +2,55 @@ import hashlib
 import json
 import logging
 import os
+import sqlite3
+import threading
+import time
 
 from .library import Media
+from .settings import Settings
 
 
 logger = logging.getLogger(__name__)
 
 
+class HistoryFlusher(threading.Thread):
+
+    def __init__(self, history: "History | SqliteHistory", interval_seconds: float):
+        threading.Thread.__init__(self, daemon=True)
+        self.history = history
+        self.interval_seconds = interval_seconds
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval_seconds):
+            self.history.flush()
+
+    def close(self):
+        self._stop_event.set()
+
+
 class History:
+    """Watch progress of medias, stored as JSON files of medias grouped by
+    hash buckets. Updates are kept in memory and written behind, every
+    `flush_interval_seconds`, so that a crash loses at most one interval. If
+    the interval is zero, updates are written immediately.
+    """
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, flush_interval_seconds: float = 0):
         self._path = path
         os.makedirs(self._path, exist_ok=True)
         self._data = {}
+        self._lock = threading.Lock()
+        # Flushes run from the flusher, the player event thread and on close:
+        # they are serialized so that an older snapshot of a bucket is never
+        # written over a newer one
+        self._flush_lock = threading.Lock()
+        self._dirty: set[str] = set()
         self._load()
+        self._flusher: HistoryFlusher | None = None
+        if flush_interval_seconds > 0:
+            self._flusher = HistoryFlusher(self, flush_interval_seconds)
+            self._flusher.start()
     
     def _hashstr(self, key: str) -> str:
         return hashlib.md5(key.encode()).hexdigest()
@@ -26,6 +61,9 @@ class History:
     def _load(self):
         self._data = {}
         for path in next(os.walk(self._path))[2]:
+            if not path.endswith(".json"):
+                # Leftover of an interrupted write
+                continue
             with open(os.path.join(self._path, path), "r", encoding="utf8") as file:
                 data = json.load(file)
             if not data:
@@ -37,20 +75,197 @@ class History:
         hashed_key = self._hash(key)
         return self._data.get(hashed_key, {}).get(key.path.as_posix(), 0)
 
-    def _save(self, hashed_key: str):
+    def _save(self, hashed_key: str, data: dict | None):
+        """Write a bucket atomically, or remove it if `data` is None.
+        """
         path = os.path.join(self._path, f"{hashed_key}.json")
-        with open(path, "w", encoding="utf8") as file:
-            json.dump(self._data[hashed_key], file)
+        if data is None:
+            if os.path.isfile(path):
+                os.remove(path)
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as file:
+            json.dump(data, file)
+        os.replace(tmp_path, path)
+
+    def _mark(self, hashed_key: str):
+        with self._lock:
+            self._dirty.add(hashed_key)
+        if self._flusher is None:
+            self.flush()
+
+    def flush(self):
+        """Write the buckets updated since the last flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                buckets = {
+                    hashed_key: dict(self._data[hashed_key]) if hashed_key in self._data else None
+                    for hashed_key in self._dirty
+                }
+                self._dirty.clear()
+            if not buckets:
+                return
+            logger.debug("Flushing %d history buckets", len(buckets))
+            for hashed_key, data in buckets.items():
+                try:
+                    self._save(hashed_key, data)
+                except OSError as err:
+                    logger.error("Could not save history bucket %s: %s", hashed_key, err)
+                    with self._lock:
+                        self._dirty.add(hashed_key)
+
+    def close(self):
+        if self._flusher is not None:
+            self._flusher.close()
+        self.flush()
 
     def update(self, key: Media, value: int):
         logger.debug("Setting %s to %d", key, value)
         hashed_key = self._hash(key)
-        self._data.setdefault(hashed_key, {})
-        self._data[hashed_key][key.path.as_posix()] = value
-        self._save(hashed_key)
+        with self._lock:
+            self._data.setdefault(hashed_key, {})
+            self._data[hashed_key][key.path.as_posix()] = value
+        self._mark(hashed_key)
+
+    def move(self, old_path: str, new_path: str):
+        """Carry the progress of the media at `old_path` over to `new_path`
+        (paths relative to the library root, in POSIX form).
+        """
+        old_hashed_key = self._hashstr(old_path)
+        new_hashed_key = self._hashstr(new_path)
+        with self._lock:
+            if old_path not in self._data.get(old_hashed_key, {}):
+                return
+            logger.info("Moving history of %s to %s", old_path, new_path)
+            value = self._data[old_hashed_key].pop(old_path)
+            if not self._data[old_hashed_key]:
+                del self._data[old_hashed_key]
+            self._data.setdefault(new_hashed_key, {})
+            self._data[new_hashed_key][new_path] = value
+            self._dirty.add(old_hashed_key)
+        self._mark(new_hashed_key)
 
     def to_dict(self) -> dict:
         d1 = {}
-        for d2 in self._data.values():
-            d1.update(d2)
-        return d1
\ No newline at end of file
+        with self._lock:
+            for d2 in self._data.values():
+                d1.update(d2)
+        return d1
+
+
+class SqliteHistory:
+    """Watch progress of medias stored in a SQLite database, keyed by the media
+    path, which is the primary key of a table without rowid. Updates are
+    written behind, as with `History`.
+
+    When the database is created, the history folder of the JSON backend is
+    imported, if there is one.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS history (
+        path TEXT PRIMARY KEY,
+        progress INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    """
+
+    # Incremented once the JSON history is imported
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path: str, flush_interval_seconds: float = 0, legacy_path: str | None = None):
+        self._path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(self.SCHEMA)
+        self._migrate(legacy_path)
+        self._pending: dict[str, tuple[int, int]] = {}
+        self._flusher: HistoryFlusher | None = None
+        if flush_interval_seconds > 0:
+            self._flusher = HistoryFlusher(self, flush_interval_seconds)
+            self._flusher.start()
+
+    def _migrate(self, legacy_path: str | None):
+        version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+        rows = []
+        if legacy_path is not None and os.path.isdir(legacy_path):
+            for filename in next(os.walk(legacy_path))[2]:
+                if not filename.endswith(".json"):
+                    continue
+                filepath = os.path.join(legacy_path, filename)
+                with open(filepath, "r", encoding="utf8") as file:
+                    data = json.load(file)
+                updated_at = int(os.path.getmtime(filepath))
+                rows.extend((key, value, updated_at) for key, value in data.items())
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO history (path, progress, updated_at) VALUES (?, ?, ?)",
+                rows)
+            self._connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        if rows:
+            logger.info("Imported %d history entries from %s into %s", len(rows), legacy_path, self._path)
+
+    def __getitem__(self, key: Media) -> int:
+        path = key.path.as_posix()
+        with self._lock:
+            if path in self._pending:
+                return self._pending[path][0]
+            row = self._connection.execute("SELECT progress FROM history WHERE path = ?", (path,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def update(self, key: Media, value: int):
+        logger.debug("Setting %s to %d", key, value)
+        with self._lock:
+            self._pending[key.path.as_posix()] = (value, int(time.time()))
+        if self._flusher is None:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            rows = [(path, value, updated_at) for path, (value, updated_at) in self._pending.items()]
+            self._pending.clear()
+            logger.debug("Flushing %d history entries", len(rows))
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO history (path, progress, updated_at) VALUES (?, ?, ?)",
+                    rows)
+
+    def move(self, old_path: str, new_path: str):
+        """Carry the progress of the media at `old_path` over to `new_path`
+        (paths relative to the library root, in POSIX form).
+        """
+        self.flush()
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "UPDATE OR REPLACE history SET path = ? WHERE path = ?",
+                (new_path, old_path))
+        if cursor.rowcount:
+            logger.info("Moving history of %s to %s", old_path, new_path)
+
+    def close(self):
+        if self._flusher is not None:
+            self._flusher.close()
+        self.flush()
+
+    def to_dict(self) -> dict:
+        self.flush()
+        with self._lock:
+            return dict(self._connection.execute("SELECT path, progress FROM history"))
+
+
+def create_history(settings: Settings) -> History | SqliteHistory:
+    if settings.history_backend == "sqlite":
+        return SqliteHistory(
+            settings.history_database_path,
+            settings.history_flush_interval_seconds,
+            legacy_path=settings.history_path)
+    return History(settings.history_path, settings.history_flush_interval_seconds)
@@ -1,7 +1,10 @@
+import concurrent.futures
 import dataclasses
+import glob
 import hashlib
 import json
 import logging
+import math
 import os
 import pathlib
 import re
@@ -11,11 +14,13 @@ import time
 import unicodedata
 import urllib.parse
 import warnings
-from typing import Literal
+from typing import Iterable, Iterator, Literal
 
 import tqdm
 import requests
+import requests.adapters
 
+from .metadata import MetadataStore, content_fingerprint, trim_probe
 from .settings import Settings, ChromecastGeneration
 
 
@@ -27,28 +32,100 @@ SUBTITLE_FILE = 1
 SUBTITLE_LANG_PATTERN = re.compile(r"\.([a-z]{2,3})$")
 
 
-def probe_video(path: pathlib.Path, hidden_directory: str) -> dict:
-    logger.info("Probing video at %s", path)
-    probe_path = path.parent / hidden_directory / (path.stem + ".probe.json")
-    probe_path.parent.mkdir(exist_ok=True)
-    if probe_path.is_file():
-        with probe_path.open("r", encoding="utf8") as file:
-            data = json.load(file)
+def probe_video(
+        path: pathlib.Path,
+        hidden_directory: str,
+        metadata: MetadataStore,
+        key: str,
+        stat: os.stat_result | None = None) -> dict:
+    """
+    @param key: media path relative to the library root, used as metadata key
+    @param stat: result of `os.stat` on the media file, if already known
+    """
+    if stat is None:
+        stat = path.stat()
+    data = metadata.get(key, stat)
+    if data is not None:
+        if metadata.get_fingerprint(key) is None:
+            metadata.put(key, stat, data, content_fingerprint(path, stat.st_size))
+        return data
+    fingerprint = content_fingerprint(path, stat.st_size)
+    data = carry_over_media(path, hidden_directory, metadata, key, fingerprint)
+    if data is not None:
+        metadata.put(key, stat, data, fingerprint)
         return data
-    data = json.loads(subprocess.check_output([
-        "ffprobe",
-        "-v",
-        "quiet",
-        "-print_format",
-        "json",
-        "-show_format",
-        "-show_streams",
-        path]).decode())
-    with probe_path.open("w", encoding="utf8") as file:
-        json.dump(data, file)
+    legacy_probe_path = path.parent / hidden_directory / (path.stem + ".probe.json")
+    if legacy_probe_path.is_file():
+        logger.info("Importing legacy probe at %s", legacy_probe_path)
+        with legacy_probe_path.open("r", encoding="utf8") as file:
+            data = json.load(file)
+    else:
+        logger.info("Probing video at %s", path)
+        data = json.loads(subprocess.check_output([
+            "ffprobe",
+            "-v",
+            "quiet",
+            "-print_format",
+            "json",
+            "-show_format",
+            "-show_streams",
+            path]).decode())
+    data = trim_probe(data)
+    metadata.put(key, stat, data, fingerprint)
     return data
 
 
+def carry_over_media(
+        path: pathlib.Path,
+        hidden_directory: str,
+        metadata: MetadataStore,
+        key: str,
+        fingerprint: str) -> dict | None:
+    """Look for a known media with the same content fingerprint, and return
+    its probe. If its file no longer exists, the media was moved or renamed:
+    its thumbnails and seek previews are moved along, and the move is
+    recorded so that the watch history can follow.
+    """
+    root = path.parents[len(pathlib.PurePosixPath(key).parts) - 1]
+    data = None
+    for old_key, old_data in metadata.find(fingerprint):
+        data = old_data
+        if old_key == key:
+            continue
+        old_path = root / old_key
+        if old_path.exists() or not metadata.discard(old_key):
+            continue
+        logger.info("Media moved from %s to %s", old_key, key)
+        move_media_files(old_path, path, hidden_directory)
+        metadata.add_move(old_key, key)
+        break
+    return data
+
+
+def move_media_files(old_path: pathlib.Path, new_path: pathlib.Path, hidden_directory: str):
+    """Move the files generated for the media at `old_path` (thumbnails and
+    seek previews) to the hidden directory of `new_path`.
+    """
+    old_directory = old_path.parent / hidden_directory
+    new_directory = new_path.parent / hidden_directory
+    if not old_directory.is_dir():
+        return
+    new_directory.mkdir(exist_ok=True)
+    for suffix in (".thumbnail", ".trickplay"):
+        for old_file in old_directory.glob(glob.escape(old_path.stem + suffix) + "*"):
+            new_file = new_directory / (new_path.stem + old_file.name[len(old_path.stem):])
+            try:
+                shutil.move(old_file, new_file)
+            except OSError as err:
+                logger.warning("Could not move %s to %s: %s", old_file, new_file, err)
+    old_sprite_path, _ = get_trickplay_paths(old_path, hidden_directory)
+    sprite_path, vtt_path = get_trickplay_paths(new_path, hidden_directory)
+    if vtt_path.is_file():
+        text = vtt_path.read_text(encoding="utf8")
+        text = text.replace(urllib.parse.quote(old_sprite_path.name), urllib.parse.quote(sprite_path.name))
+        vtt_path.write_text(text, encoding="utf8")
+
+
 def ffmpeg_timestamp(total_seconds:float) -> str:
     hours = int(total_seconds) // 3600
     minutes = (int(total_seconds) - 3600 * hours) // 60
@@ -57,14 +134,82 @@ def ffmpeg_timestamp(total_seconds:float) -> str:
     return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}"
 
 
-def extract_thumbnail(path: pathlib.Path, hidden_directory: str, width: int, height: int, duration: float) -> pathlib.Path:
+THUMBNAIL_ENCODERS = {
+    "jpg": ["-q:v", "2"],
+    "webp": ["-c:v", "libwebp", "-quality", "80"],
+    "avif": ["-c:v", "libaom-av1", "-still-picture", "1", "-crf", "35", "-cpu-used", "6", "-pix_fmt", "yuv420p"],
+}
+
+
+def get_thumbnail_path(path: pathlib.Path, hidden_directory: str, density: int = 1, format: str = "jpg") -> pathlib.Path:
+    """Return the path to a thumbnail rendition. The 1x JPEG is the base
+    thumbnail, other renditions are suffixed with their pixel density.
+    """
+    if density == 1 and format == "jpg":
+        return path.parent / hidden_directory / (path.stem + ".thumbnail.jpg")
+    return path.parent / hidden_directory / (path.stem + f".thumbnail@{density}x.{format}")
+
+
+def get_thumbnail_failure_path(thumbnail_path: pathlib.Path) -> pathlib.Path:
+    """Return the path to the marker of a thumbnail rendition that could not
+    be extracted, such as when ffmpeg lacks its encoder. Markers are removed
+    along with the hidden directories.
+    """
+    return thumbnail_path.with_name(thumbnail_path.name + ".failed")
+
+
+def extract_thumbnail(
+        path: pathlib.Path,
+        hidden_directory: str,
+        width: int,
+        height: int,
+        duration: float,
+        densities: list[int] = [1],
+        formats: list[str] = []) -> pathlib.Path:
+    """Extract the base JPEG thumbnail, along with a rendition for each pixel
+    density and format. The frame is decoded and cropped once, then split
+    and downscaled for every rendition within a single ffmpeg run. Renditions
+    that could not be extracted along with the base thumbnail are marked as
+    failed, and are not attempted again.
+    """
+    thumbnail_path = get_thumbnail_path(path, hidden_directory)
+    renditions = [(density, format) for format in formats for density in densities if (density, format) != (1, "jpg")]
+    paths = [get_thumbnail_path(path, hidden_directory, density, format) for density, format in renditions]
+    if thumbnail_path.is_file() and all(p.is_file() or get_thumbnail_failure_path(p).is_file() for p in paths):
+        return thumbnail_path.relative_to(path.parent)
+    _extract_thumbnail(path, hidden_directory, width, height, duration, densities, formats)
+    if thumbnail_path.is_file():
+        for rendition_path in paths:
+            if not rendition_path.is_file():
+                logger.warning("Could not extract thumbnail rendition %s", rendition_path)
+                try:
+                    get_thumbnail_failure_path(rendition_path).touch()
+                except OSError:
+                    pass
+    return thumbnail_path.relative_to(path.parent)
+
+
+def _extract_thumbnail(
+        path: pathlib.Path,
+        hidden_directory: str,
+        width: int,
+        height: int,
+        duration: float,
+        densities: list[int] = [1],
+        formats: list[str] = []):
     logger.info("Extracting thumbnail of %s (duration is %f)", path, duration)
-    thumbnail_path = path.parent / hidden_directory / (path.stem + ".thumbnail.jpg")
+    thumbnail_path = get_thumbnail_path(path, hidden_directory)
     thumbnail_path.parent.mkdir(exist_ok=True)
-    if thumbnail_path.is_file():
-        return thumbnail_path.relative_to(path.parent)
-    w = str(width)
-    h = str(height)
+    renditions = [(1, "jpg")] + [(density, format) for format in formats for density in densities]
+    paths = [get_thumbnail_path(path, hidden_directory, density, format) for density, format in renditions]
+    scale = max(density for density, _ in renditions)
+    w = str(width * scale)
+    h = str(height * scale)
+    filters = [f"[0:v]scale='max({w},{h}*iw/ih)':'max({h},{w}*ih/iw)',crop={w}:{h},split={len(renditions)}" + "".join(f"[s{i}]" for i in range(len(renditions)))]
+    outputs = []
+    for i, ((density, format), output_path) in enumerate(zip(renditions, paths)):
+        filters.append(f"[s{i}]scale={width * density}:{height * density}:flags=lanczos[o{i}]")
+        outputs += ["-map", f"[o{i}]", "-frames:v", "1", *THUMBNAIL_ENCODERS[format], str(output_path)]
     process = subprocess.Popen(
         [
             "ffmpeg",
@@ -73,11 +218,8 @@ def extract_thumbnail(path: pathlib.Path, hidden_directory: str, width: int, hei
             "-skip_frame", "nokey",
             "-ss", ffmpeg_timestamp(duration),
             "-i", path,
-            "-frames:v", "1",
-            "-q:v", "2",
-            "-vf",
-            f"scale='max({w},{h}*iw/ih)':'max({h},{w}*ih/iw)',crop={w}:{h}",
-            str(thumbnail_path),
+            "-filter_complex", ";".join(filters),
+            *outputs,
             "-y"
         ],
         stdout=subprocess.PIPE,
@@ -86,12 +228,254 @@ def extract_thumbnail(path: pathlib.Path, hidden_directory: str, width: int, hei
     _, err = process.communicate()
     if process.returncode != 0:
         logger.warning(f"\r\nAn error occured while extracting thumbnail for '{path}':\n    " + re.sub("\r?\n", "\n    ", err.decode().strip()))
+        if formats:
+            logger.debug("Retrying without additional formats")
+            return _extract_thumbnail(path, hidden_directory, width, height, duration)
         if duration > 0:
             logger.debug("Retrying with first frame")
-            return extract_thumbnail(path, hidden_directory, width, height, 0)
+            return _extract_thumbnail(path, hidden_directory, width, height, 0)
     if not thumbnail_path.is_file() and duration > 0:
-        return extract_thumbnail(path, hidden_directory, width, height, 0)
-    return thumbnail_path.relative_to(path.parent)
+        return _extract_thumbnail(path, hidden_directory, width, height, 0, densities, formats)
+
+
+def get_trickplay_paths(path: pathlib.Path, hidden_directory: str) -> tuple[pathlib.Path, pathlib.Path]:
+    """Return the paths to the sprite sheet and to the WebVTT index of the
+    seek previews of the media at `path`.
+    """
+    directory = path.parent / hidden_directory
+    return directory / (path.stem + ".trickplay.jpg"), directory / (path.stem + ".trickplay.vtt")
+
+
+def write_trickplay_index(
+        vtt_path: pathlib.Path,
+        sprite_name: str,
+        duration: float,
+        interval: int,
+        columns: int,
+        width: int,
+        height: int):
+    """Write the WebVTT index mapping each interval of the media to its tile
+    within the sprite sheet, using media fragments (`#xywh=x,y,w,h`).
+    """
+    count = max(1, math.ceil(duration / interval))
+    lines = ["WEBVTT", ""]
+    for i in range(count):
+        start = i * interval
+        end = min((i + 1) * interval, duration)
+        x = (i % columns) * width
+        y = (i // columns) * height
+        lines.append(f"{ffmpeg_timestamp(start)} --> {ffmpeg_timestamp(end)}")
+        lines.append(f"{urllib.parse.quote(sprite_name)}#xywh={x},{y},{width},{height}")
+        lines.append("")
+    vtt_path.write_text("\n".join(lines), encoding="utf8")
+
+
+def extract_trickplay(
+        path: pathlib.Path,
+        hidden_directory: str,
+        duration: float,
+        interval: int,
+        columns: int,
+        width: int,
+        height: int) -> pathlib.Path | None:
+    """Generate the seek previews of the media at `path`: one tile every
+    `interval` seconds, packed in a single sprite sheet. Only keyframes are
+    decoded, within a single ffmpeg run. Return the path to the WebVTT index,
+    relative to the media folder, or None if the extraction failed.
+    """
+    sprite_path, vtt_path = get_trickplay_paths(path, hidden_directory)
+    if sprite_path.is_file() and vtt_path.is_file():
+        return vtt_path.relative_to(path.parent)
+    logger.info("Extracting seek previews of %s", path)
+    sprite_path.parent.mkdir(exist_ok=True)
+    count = max(1, math.ceil(duration / interval))
+    columns = min(columns, count)
+    rows = math.ceil(count / columns)
+    process = subprocess.Popen(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "error",
+            "-skip_frame", "nokey",
+            "-i", path,
+            "-an", "-sn",
+            "-vf",
+            f"fps=1/{interval},scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,tile={columns}x{rows}",
+            "-frames:v", "1",
+            "-q:v", "5",
+            str(sprite_path),
+            "-y"
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    _, err = process.communicate()
+    if process.returncode != 0 or not sprite_path.is_file():
+        logger.warning(f"\r\nAn error occured while extracting seek previews for '{path}':\n    " + re.sub("\r?\n", "\n    ", err.decode().strip()))
+        return None
+    write_trickplay_index(vtt_path, sprite_path.name, duration, interval, columns, width, height)
+    return vtt_path.relative_to(path.parent)
+
+
+@dataclasses.dataclass
+class DirectoryListing:
+    """Contents of a library directory, read with a single `os.scandir` call.
+    Entry types come from the listing itself, except for symbolic links, and
+    file stats are read once through `os.DirEntry` (one `stat` call per file
+    on Linux) and reused by the scan.
+    """
+
+    path: pathlib.Path
+    mtime_ns: int
+    dirs: list[str]
+    files: list[tuple[str, os.stat_result]]
+
+    @property
+    def fingerprint(self) -> str:
+        """Summarize the state of the directory from its modification time and
+        the name, size and modification time of its entries. The hidden
+        directory and the contents of subfolders are ignored.
+        """
+        entries = [(name, -1, 0) for name in self.dirs]
+        entries += [(name, stat.st_size, stat.st_mtime_ns) for name, stat in self.files]
+        entries.sort()
+        data = [self.mtime_ns, len(entries), entries]
+        return hashlib.sha1(json.dumps(data).encode()).hexdigest()
+
+    def refresh_mtime(self, root: pathlib.Path):
+        self.mtime_ns = (root / self.path).stat().st_mtime_ns
+
+    @classmethod
+    def from_scan(cls, root: pathlib.Path, path: pathlib.Path, hidden_directory: str):
+        """
+        @param path: directory path, relative to `root`
+        """
+        fullpath = root / path
+        dirs: list[str] = []
+        files: list[tuple[str, os.stat_result]] = []
+        with os.scandir(fullpath) as iterator:
+            for entry in iterator:
+                if entry.name == hidden_directory:
+                    continue
+                try:
+                    # Symbolic links to directories are listed as
+                    # subfolders, as `os.walk` does
+                    if entry.is_dir():
+                        dirs.append(entry.name)
+                    else:
+                        files.append((entry.name, entry.stat()))
+                except OSError as err:
+                    # Such as broken symbolic links
+                    logger.debug("Skipping entry %s: %s", entry.path, err)
+        return cls(path, os.stat(fullpath).st_mtime_ns, dirs, files)
+
+
+def walk_library(root: pathlib.Path, hidden_directory: str, top: pathlib.Path = pathlib.Path(".")) -> Iterator[DirectoryListing]:
+    """Walk the library top-down and depth-first, listing each directory
+    exactly once. Symbolic links to directories are followed, such as disks
+    linked into the library, but a directory already walked through another
+    path is not walked again, so that link loops end.
+
+    @param top: directory to start from, relative to `root`
+    """
+    stack = [top]
+    visited: set[tuple[int, int]] = set()
+    while stack:
+        path = stack.pop()
+        try:
+            stat = os.stat(root / path)
+            if (stat.st_dev, stat.st_ino) in visited:
+                logger.debug("Skipping directory walked already: %s", root / path)
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            listing = DirectoryListing.from_scan(root, path, hidden_directory)
+        except OSError as err:
+            logger.warning("Could not list directory %s: %s", root / path, err)
+            continue
+        yield listing
+        stack.extend(path / dirname for dirname in reversed(listing.dirs))
+
+
+def get_media_type_string(
+        ext: str | None,
+        video_codec: str | None,
+        video_profile: str | None,
+        video_level: int | None,
+        audio_codec: str | None,
+        audio_profile: str | None) -> str:
+    """
+    @see https://developers.google.com/cast/docs/media
+    """
+    container = None
+    match ext:
+        case ".mp4":
+            container = "video/mp4"
+        case ".webm":
+            container = "video/webm"
+        case ".mkv":
+            container = "video/x-matroska"
+        case _:
+            container = "video/mp4"
+    video_type = None
+    match video_codec:
+        case "h264":
+            if video_level == 30 and video_profile == "Baseline":
+                video_type = "avc1.42E01E"
+            elif video_level == 31 and video_profile == "Baseline":
+                video_type = "avc1.42E01F"
+            elif video_level == 31 and video_profile == "Main":
+                video_type = "avc1.4D401F"
+            elif video_level == 40 and video_profile == "Main":
+                video_type = "avc1.4D4028"
+            elif video_level == 40 and video_profile == "High":
+                video_type = "avc1.640028"
+            elif video_level == 41 and video_profile == "High":
+                video_type = "avc1.640029"
+            elif video_level == 42 and video_profile == "High":
+                video_type = "avc1.64002A"
+        case "vp8" | "vp9":
+            video_type = video_codec
+    if video_type is None:
+        video_type = video_codec
+    audio_type = None
+    match audio_codec:
+        case "aac":
+            if audio_profile == "HE":
+                audio_type = "mp4a.40.5"
+            elif audio_profile == "LC":
+                audio_type = "mp4a.40.2"
+        case "mp3":
+            audio_type = "mp4a.69"
+    if audio_type is None:
+        audio_type = audio_codec
+    if video_type is None and audio_type is None:
+        return container
+    if audio_type is None:
+        return container + f'; codecs="{video_type}"'
+    if video_type is None:
+        return container + f'; codecs="{audio_type}"'
+    return container + f'; codecs="{video_type}, {audio_type}"'
+
+
+def get_probe_media_type_string(ext: str, probe: dict) -> str:
+    """Return the media type of a media from its stored probe, read as in
+    `Media.from_path`, without building the media.
+    """
+    video: dict = {}
+    audio: dict = {}
+    for stream in probe["streams"]:
+        match stream["codec_type"]:
+            case "video":
+                video = stream
+            case "audio":
+                audio = stream
+    return get_media_type_string(
+        ext.lower(),
+        video.get("codec_name"),
+        video.get("profile"),
+        int(video.get("level", 0)) if video else None,
+        audio.get("codec_name"),
+        audio.get("profile"))
 
 
 class AudioSource:
@@ -196,7 +580,8 @@ class Media(LibraryEntry):
             framerate: int | None = None,
             thumbnail: str | None = None,
             audio_sources: list[AudioSource] = [],
-            subtitle_sources: list[SubtitleSource] = []):
+            subtitle_sources: list[SubtitleSource] = [],
+            trickplay: str | None = None):
         LibraryEntry.__init__(self, settings, folder, basename)
         self.duration = duration
         self.video_codec = video_codec
@@ -207,6 +592,7 @@ class Media(LibraryEntry):
         self.resolution = resolution
         self.framerate = framerate
         self.thumbnail = thumbnail
+        self.trickplay = trickplay
         self.audio_sources = audio_sources[:]
         self.subtitle_sources = subtitle_sources[:]
         self.name = "Unnamed"
@@ -332,58 +718,13 @@ class Media(LibraryEntry):
 
     @property
     def media_type_string(self) -> str:
-        """
-        @see https://developers.google.com/cast/docs/media
-        """
-        container = None
-        match self.ext:
-            case ".mp4":
-                container = "video/mp4"
-            case ".webm":
-                container = "video/webm"
-            case ".mkv":
-                container = "video/x-matroska"
-            case _:
-                container = "video/mp4"
-        video_codec = None
-        match self.video_codec:
-            case "h264":
-                if self.video_level == 30 and self.video_profile == "Baseline":
-                    video_codec = "avc1.42E01E"
-                elif self.video_level == 31 and self.video_profile == "Baseline":
-                    video_codec = "avc1.42E01F"
-                elif self.video_level == 31 and self.video_profile == "Main":
-                    video_codec = "avc1.4D401F"
-                elif self.video_level == 40 and self.video_profile == "Main":
-                    video_codec = "avc1.4D4028"
-                elif self.video_level == 40 and self.video_profile == "High":
-                    video_codec = "avc1.640028"
-                elif self.video_level == 41 and self.video_profile == "High":
-                    video_codec = "avc1.640029"
-                elif self.video_level == 42 and self.video_profile == "High":
-                    video_codec = "avc1.64002A"
-            case "vp8" | "vp9":
-                video_codec = self.video_codec
-        if video_codec is None:
-            video_codec = self.video_codec
-        audio_codec = None
-        match self.audio_codec:
-            case "aac":
-                if self.audio_profile == "HE":
-                    audio_codec = "mp4a.40.5"
-                elif self.audio_profile == "LC":
-                    audio_codec = "mp4a.40.2"
-            case "mp3":
-                audio_codec = "mp4a.69"
-        if audio_codec is None:
-            audio_codec = self.audio_codec
-        if video_codec is None and audio_codec is None:
-            return container
-        if audio_codec is None:
-            return container + f'; codecs="{video_codec}"'
-        if video_codec is None:
-            return container + f'; codecs="{audio_codec}"'
-        return container + f'; codecs="{video_codec}, {audio_codec}"'
+        return get_media_type_string(
+            self.ext,
+            self.video_codec,
+            self.video_profile,
+            self.video_level,
+            self.audio_codec,
+            self.audio_profile)
 
     @property
     def audio_and_subs_hash(self) -> str:
@@ -405,6 +746,7 @@ class Media(LibraryEntry):
             "resolution": self.resolution,
             "framerate": self.framerate,
             "thumbnail": str(self.thumbnail),
+            "trickplay": None if self.trickplay is None else pathlib.Path(self.trickplay).as_posix(),
             "audio_sources": [s.to_dict() for s in self.audio_sources],
             "subtitle_sources": [s.to_dict() for s in self.subtitle_sources],
             "folder": self.folder.path.as_posix(),
@@ -469,13 +811,15 @@ class Media(LibraryEntry):
             d["framerate"],
             d["thumbnail"],
             [AudioSource.from_dict(s) for s in d["audio_sources"]],
-            [SubtitleSource.from_dict(s) for s in d["subtitle_sources"]]
+            [SubtitleSource.from_dict(s) for s in d["subtitle_sources"]],
+            d.get("trickplay")
         )
 
     @classmethod
-    def from_path(cls, settings: Settings, folder: "LibraryFolder", path: pathlib.Path):
+    def from_path(cls, settings: Settings, folder: "LibraryFolder", path: pathlib.Path, stat: os.stat_result | None = None):
         logger.debug("Analyzing media at %s", path)
-        probe = probe_video(path, settings.hidden_directory)
+        metadata = MetadataStore.from_settings(settings)
+        probe = probe_video(path, settings.hidden_directory, metadata, (folder.path / path.name).as_posix(), stat)
         media = cls(settings, folder, path.name, float(probe["format"]["duration"]))
         for stream in probe["streams"]:
             match stream["codec_type"]:
@@ -506,12 +850,26 @@ class Media(LibraryEntry):
                         tags.get("language"),
                         tags.get("title")
                     ))
-        media.thumbnail = extract_thumbnail(
-            path,
-            settings.hidden_directory,
-            settings.thumbnail_width,
-            settings.thumbnail_height,
-            media.duration / 2)
+        if settings.lazy_thumbnails:
+            media.thumbnail = get_thumbnail_path(path, settings.hidden_directory).relative_to(path.parent)
+        else:
+            media.thumbnail = extract_thumbnail(
+                path,
+                settings.hidden_directory,
+                settings.thumbnail_width,
+                settings.thumbnail_height,
+                media.duration / 2,
+                settings.thumbnail_densities,
+                settings.thumbnail_formats)
+        if settings.trickplay:
+            media.trickplay = extract_trickplay(
+                path,
+                settings.hidden_directory,
+                media.duration,
+                settings.trickplay_interval_seconds,
+                settings.trickplay_columns,
+                settings.trickplay_width,
+                settings.trickplay_height)
         return media
 
 
@@ -610,6 +968,7 @@ class LibraryFolder:
         self._subfolders_index = { x.basename: x for x in self.subfolders }
         self.playlists = playlists[:]
         self._playlists_index = { x.basename: x for x in self.playlists }
+        self.fingerprint: str | None = None
 
     def index(self, media: Media) -> int | None:
         """Return index of media in media list.
@@ -635,6 +994,20 @@ class LibraryFolder:
     def get_media(self, basename: str) -> Media | None:
         return self._media_index.get(basename)
 
+    def _reuse_media(self, folder: "LibraryFolder", path: pathlib.Path, stat: os.stat_result) -> Media | None:
+        """Move a media of this folder to `folder` if its metadata is still
+        valid. Subtitle files are detached, as the scan adds them again.
+        """
+        media = self.get_media(path.name)
+        if media is None:
+            return None
+        metadata = MetadataStore.from_settings(media.settings)
+        if not metadata.is_fresh(media.path.as_posix(), stat):
+            return None
+        media.folder = folder
+        media.subtitle_sources = [s for s in media.subtitle_sources if not isinstance(s, SubtitleFile)]
+        return media
+
     def add_subfolder(self, folder: Folder):
         self.subfolders.append(folder)
         self._subfolders_index[folder.basename] = folder
@@ -666,9 +1039,21 @@ class LibraryFolder:
         }
 
     @classmethod
-    def from_scan(cls, settings: Settings, root: str | pathlib.Path, path: pathlib.Path, quiet: bool = True):
+    def from_scan(
+            cls,
+            settings: Settings,
+            root: str | pathlib.Path,
+            path: pathlib.Path,
+            quiet: bool = True,
+            executor: concurrent.futures.Executor | None = None,
+            previous: "LibraryFolder | None" = None,
+            listing: DirectoryListing | None = None):
         """
         @param document_root: library document root,
+        @param executor: if set, medias are analyzed concurrently in this pool
+        @param previous: previous state of the folder, whose medias are reused
+            if their file did not change
+        @param listing: contents of the directory, if it was already listed
         """
         folder = cls(settings, path)
         if isinstance(root, str):
@@ -678,32 +1063,44 @@ class LibraryFolder:
             logger.error("Could not scan library folder at %s", fullpath)
             return folder
         logger.info("Scanning library folder at %s", fullpath)
-        try:
-            _, dirs, files = next(os.walk(str(fullpath)))
-        except StopIteration:
-            return folder
+        if listing is None:
+            try:
+                listing = DirectoryListing.from_scan(root, path, settings.hidden_directory)
+            except OSError:
+                return folder
+        dirs, files = listing.dirs, listing.files
         pbar = tqdm.tqdm(total=len(dirs) + len(files), disable=quiet)
         subtitle_paths: list[pathlib.Path] = []
         medias_names: dict[str, Media] = {}
+        media_futures: list[concurrent.futures.Future[Media]] = []
         for dirname in dirs:
             pbar.set_description(dirname)
             pbar.update(1)
-            if dirname == settings.hidden_directory:
-                continue
             folder.add_subfolder(Folder.from_path(settings, folder, dirname))
-        for filename in files:
+        for filename, stat in files:
             pbar.set_description(filename)
             pbar.update(1)
             path = fullpath / filename
             ext = path.suffix.lower()
             if ext in settings.video_exts:
-                media = Media.from_path(settings, folder, path)
-                medias_names[media.name] = media
-                folder.add_media(media)
+                media = None if previous is None else previous._reuse_media(folder, path, stat)
+                if media is not None:
+                    medias_names[media.name] = media
+                    folder.add_media(media)
+                elif executor is None:
+                    media = Media.from_path(settings, folder, path, stat)
+                    medias_names[media.name] = media
+                    folder.add_media(media)
+                else:
+                    media_futures.append(executor.submit(Media.from_path, settings, folder, path, stat))
             elif ext in settings.subtitle_exts:
                 subtitle_paths.append(path)
             elif ext in settings.playlist_exts:
                 folder.add_playlist(Playlist.from_path(settings, folder, path))
+        for future in media_futures:
+            media = future.result()
+            medias_names[media.name] = media
+            folder.add_media(media)
         pbar.close()
         for path in subtitle_paths:
             name = path.stem
@@ -720,9 +1117,9 @@ class LibraryFolder:
         return folder
 
     @classmethod
-    def from_url(cls, settings: Settings, url: str):
+    def from_url(cls, settings: Settings, url: str, session: requests.Session | None = None):
         logger.info("Fetching library folder at %s", url)
-        d = requests.get(url).json()
+        d = (session or requests).get(url).json()
         return cls.from_dict(settings, d)
 
     @classmethod
@@ -783,22 +1180,25 @@ class Hierarchy:
         return cls(pathlib.Path(d["root"]), folders)
 
     @classmethod
-    def from_scan(cls, settings: Settings, root: pathlib.Path):
-        logger.info("Exploring hierarchy at %s", root)
-        folders = []
+    def from_listings(cls, settings: Settings, root: pathlib.Path, listings: Iterable[DirectoryListing]):
         f = lambda filename: os.path.splitext(filename)[1] in settings.video_exts
-        for dirpath, _, files in os.walk(root):
-            if os.path.basename(dirpath) == settings.hidden_directory:
-                continue
-            folders.append(HierarchyElement(
-                pathlib.Path(dirpath).relative_to(root).as_posix(),
-                len(list(filter(f, files)))))
+        folders = [
+            HierarchyElement(
+                listing.path.as_posix(),
+                len([filename for filename, _ in listing.files if f(filename)]))
+            for listing in listings
+        ]
         return cls(root, folders)
 
     @classmethod
-    def from_url(cls, url: str):
+    def from_scan(cls, settings: Settings, root: pathlib.Path):
+        logger.info("Exploring hierarchy at %s", root)
+        return cls.from_listings(settings, root, walk_library(root, settings.hidden_directory))
+
+    @classmethod
+    def from_url(cls, url: str, session: requests.Session | None = None):
         logger.info("Fetching hierarchy at %s", url)
-        d = requests.get(url + "hierarchy.json").json()
+        d = (session or requests).get(url + "hierarchy.json").json()
         return cls.from_dict(d)
 
     @classmethod
@@ -851,40 +1251,196 @@ class Library(dict[str, LibraryFolder]):
             [LibraryFolder.from_dict(settings, dd) for dd in d["folders"]])
 
     @classmethod
-    def from_scan(cls, settings: Settings):
+    def from_scan(cls, settings: Settings, previous: "Library | None" = None, incremental: bool | None = None):
+        """
+        @param previous: library whose folders can be reused if unchanged
+        @param incremental: only scan folders whose fingerprint changed since
+            they were last scanned, defaults to the `incremental_scan` setting
+        """
         root = pathlib.Path(settings.library_root)
         logger.info("Scanning library at %s", root)
         if not root.is_dir():
             logger.error("Library root does not exist: %s", root)
             raise FileNotFoundError(str(root))
+        if incremental is None:
+            incremental = settings.incremental_scan
         library = cls(settings, root)
-        hierarchy = Hierarchy.from_settings(settings)
+        metadata = MetadataStore.from_settings(settings)
+        logger.info("Exploring hierarchy at %s", root)
+        listings = {
+            listing.path.as_posix(): listing
+            for listing in walk_library(root, settings.hidden_directory)
+        }
+        hierarchy = Hierarchy.from_listings(settings, root, listings.values())
         total = sum([folder.medias for folder in hierarchy.folders])
         pbar = tqdm.tqdm(total=total, desc="Scanning library", unit="media")
+        folders: dict[str, LibraryFolder] = {}
+        pending: list[HierarchyElement] = []
         for folder in hierarchy.folders:
-            folder_path = pathlib.Path(folder.path)
-            logger.debug("Adding folder to library: %s", folder_path)
-            library_folder = LibraryFolder.from_scan(settings, library.root, folder_path, True)
-            library[folder_path.as_posix()] = library_folder
-            pbar.update(folder.medias)
+            key = pathlib.Path(folder.path).as_posix()
+            library_folder = None
+            if incremental:
+                library_folder = cls._get_unchanged_folder(settings, metadata, listings[key], previous)
+            if library_folder is None:
+                pending.append(folder)
+            else:
+                folders[key] = library_folder
+                pbar.update(folder.medias)
+        logger.info("Reusing %d folders, scanning %d folders", len(folders), len(pending))
+        scanned: dict[str, LibraryFolder] = {}
+        if settings.scan_jobs <= 1:
+            for folder in pending:
+                folder_path = pathlib.Path(folder.path)
+                logger.debug("Adding folder to library: %s", folder_path)
+                scanned[folder_path.as_posix()] = LibraryFolder.from_scan(settings, library.root, folder_path, True, listing=listings[folder_path.as_posix()])
+                pbar.update(folder.medias)
+        else:
+            logger.info("Scanning with %d jobs", settings.scan_jobs)
+            # Folder scans only wait for their medias, while medias are analyzed
+            # in a separate pool, which bounds the number of ffprobe and ffmpeg
+            # subprocesses running at once.
+            with concurrent.futures.ThreadPoolExecutor(settings.scan_jobs, "scan-media") as media_pool,\
+                    concurrent.futures.ThreadPoolExecutor(settings.scan_jobs, "scan-folder") as folder_pool:
+                futures: dict[concurrent.futures.Future[LibraryFolder], HierarchyElement] = {}
+                for folder in pending:
+                    logger.debug("Adding folder to library: %s", folder.path)
+                    folder_path = pathlib.Path(folder.path)
+                    future = folder_pool.submit(LibraryFolder.from_scan, settings, library.root, folder_path, True, media_pool, None, listings[folder_path.as_posix()])
+                    futures[future] = folder
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+                    pbar.update(futures[future].medias)
+                for future, folder in futures.items():
+                    scanned[pathlib.Path(folder.path).as_posix()] = future.result()
         pbar.close()
+        for key, library_folder in scanned.items():
+            # The directory mtime is read again after the scan, since it may
+            # have created the hidden directory.
+            listings[key].refresh_mtime(root)
+            library_folder.fingerprint = listings[key].fingerprint
+            metadata.put_folder(key, library_folder.fingerprint, library_folder.to_dict())
+        folders.update(scanned)
+        for folder in hierarchy.folders:
+            key = pathlib.Path(folder.path).as_posix()
+            library[key] = folders[key]
+        library.prune_metadata()
         return library
 
+    @staticmethod
+    def _get_unchanged_folder(
+            settings: Settings,
+            metadata: MetadataStore,
+            listing: DirectoryListing,
+            previous: "Library | None") -> "LibraryFolder | None":
+        """Return the listed folder from the previous library or from the
+        metadata store if its directory fingerprint did not change.
+        """
+        key = listing.path.as_posix()
+        fingerprint = listing.fingerprint
+        if previous is not None and key in previous and previous[key].fingerprint == fingerprint:
+            return previous[key]
+        d = metadata.get_folder(key, fingerprint)
+        if d is None:
+            return None
+        library_folder = LibraryFolder.from_dict(settings, d)
+        library_folder.fingerprint = fingerprint
+        return library_folder
+
+    def refresh_folders(self, keys: set[str]) -> "Library":
+        """Scan again the folders at `keys` (paths relative to the library root)
+        and return a patched copy of the library. Medias whose file did not
+        change are kept. Folders that no longer exist are removed along with
+        their subfolders, and new folders are added along with their
+        subfolders. The library itself is left untouched, so that it can be
+        read while the copy is built.
+        """
+        library = Library(self.settings, self.root)
+        library.update(self)
+        library._refresh_folders(keys)
+        return library
+
+    def _refresh_folders(self, keys: set[str]):
+        root = pathlib.Path(self.root)
+        metadata = MetadataStore.from_settings(self.settings)
+        pending = sorted(keys, key=lambda key: len(pathlib.Path(key).parts))
+        while pending:
+            key = pathlib.Path(pending.pop(0)).as_posix()
+            fullpath = root / key
+            if not fullpath.is_dir():
+                for other in list(self.keys()):
+                    if key != "." and (other == key or other.startswith(key + "/")):
+                        logger.info("Removing folder from library: %s", other)
+                        del self[other]
+                continue
+            logger.info("Updating folder in library: %s", key)
+            listing = DirectoryListing.from_scan(root, pathlib.Path(key), self.settings.hidden_directory)
+            library_folder = LibraryFolder.from_scan(self.settings, root, pathlib.Path(key), True, previous=self.get(key), listing=listing)
+            listing.refresh_mtime(root)
+            library_folder.fingerprint = listing.fingerprint
+            metadata.put_folder(key, library_folder.fingerprint, library_folder.to_dict())
+            self[key] = library_folder
+            for subfolder in library_folder.subfolders:
+                subkey = (pathlib.Path(key) / subfolder.basename).as_posix()
+                if subkey not in self and subkey not in pending:
+                    pending.append(subkey)
+
+    def prune_metadata(self):
+        """Forget metadata of medias that are no longer in the library.
+        """
+        folders = list(self.values())
+        keys = {media.path.as_posix() for folder in folders for media in folder.medias}
+        MetadataStore.from_settings(self.settings).prune(keys, {folder.path.as_posix() for folder in folders})
+
     @classmethod
     def from_url(cls, settings: Settings):
+        """Fetch the whole library in a single request if the remote server
+        supports it, otherwise fetch its folders concurrently.
+        """
         url = settings.library_root
         logger.info("Fetching library at %s", url)
         test_library_connection(settings.library_mode, settings.library_root)
+        with requests.Session() as session:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=settings.remote_fetch_jobs)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            library = cls._fetch_bulk(settings, session)
+            if library is None:
+                library = cls._fetch_folders(settings, session)
+        return library
+
+    @classmethod
+    def _fetch_bulk(cls, settings: Settings, session: requests.Session) -> "Library | None":
+        url = settings.library_root + "library.json"
+        try:
+            response = session.get(url)
+            if response.status_code != 200:
+                logger.info("Remote library does not support bulk fetch (status %d)", response.status_code)
+                return None
+            d = response.json()
+        except (requests.exceptions.RequestException, ValueError) as err:
+            logger.warning("Could not fetch library at %s: %s", url, err)
+            return None
+        library = cls.from_dict(settings, d)
+        library.root = settings.library_root
+        logger.info("Fetched %d folders at once", len(library))
+        return library
+
+    @classmethod
+    def _fetch_folders(cls, settings: Settings, session: requests.Session) -> "Library":
+        url = settings.library_root
         library = cls(settings, url)
-        hierarchy = Hierarchy.from_settings(settings)
+        hierarchy = Hierarchy.from_url(url, session)
         total = sum([folder.medias for folder in hierarchy.folders])
         pbar = tqdm.tqdm(total=total, desc="Fetching library", unit="media")
-        for folder in hierarchy.folders:
-            folder_path = pathlib.Path(folder.path)
-            folder_url = urllib.parse.urljoin(url, (folder_path / "index.json").as_posix())
-            library_folder = LibraryFolder.from_url(settings, folder_url)
-            library[folder_path.as_posix()] = library_folder
-            pbar.update(folder.medias)
+        with concurrent.futures.ThreadPoolExecutor(settings.remote_fetch_jobs, "fetch-folder") as executor:
+            futures: list[tuple[HierarchyElement, concurrent.futures.Future[LibraryFolder]]] = []
+            for folder in hierarchy.folders:
+                folder_path = pathlib.Path(folder.path)
+                folder_url = urllib.parse.urljoin(url, (folder_path / "index.json").as_posix())
+                futures.append((folder, executor.submit(LibraryFolder.from_url, settings, folder_url, session)))
+            for folder, future in futures:
+                library[pathlib.Path(folder.path).as_posix()] = future.result()
+                pbar.update(folder.medias)
         pbar.close()
         return library
 
@@ -0,0 +1,283 @@
+"""Library-wide store of media metadata, backed by a single SQLite database.
+
+Entries are keyed by the media path relative to the library root, and are
+validated against the file size, modification time and inode, so that a file
+replaced in place is detected as stale and probed again. Scanned library
+folders are stored as well, along with the fingerprint of their directory, so
+that unchanged folders do not have to be scanned again.
+
+Entries are also indexed by a fingerprint of the media content, so that a
+moved or renamed media is recognized. Such moves are recorded until the
+watch history is updated accordingly.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+
+from .settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+
+PROBE_STREAM_KEYS = ("index", "codec_type", "codec_name", "profile", "level", "width", "height", "avg_frame_rate")
+PROBE_TAG_KEYS = ("language", "title")
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+
+def trim_probe(data: dict) -> dict:
+    """Only keep the ffprobe fields `Media.from_path` actually reads.
+    """
+    streams = []
+    for stream in data.get("streams", []):
+        trimmed = {key: stream[key] for key in PROBE_STREAM_KEYS if key in stream}
+        tags = {key: value for key, value in stream.get("tags", {}).items() if key in PROBE_TAG_KEYS}
+        if tags:
+            trimmed["tags"] = tags
+        streams.append(trimmed)
+    return {
+        "format": {"duration": data["format"]["duration"]},
+        "streams": streams,
+    }
+
+
+def stat_signature(stat: os.stat_result) -> tuple[int, int, int]:
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def content_fingerprint(path: str | pathlib.Path, size: int) -> str:
+    """Cheap fingerprint of a file content: its size along with the hash of
+    three blocks sampled at its start, middle and end.
+    """
+    digest = hashlib.sha1()
+    offsets = {0, max(0, size // 2 - FINGERPRINT_BLOCK_SIZE // 2), max(0, size - FINGERPRINT_BLOCK_SIZE)}
+    with open(path, "rb") as file:
+        for offset in sorted(offsets):
+            file.seek(offset)
+            digest.update(file.read(FINGERPRINT_BLOCK_SIZE))
+    return f"{size}-{digest.hexdigest()}"
+
+
+class MetadataStore:
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS probes (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        fingerprint TEXT
+    );
+    CREATE TABLE IF NOT EXISTS folders (
+        path TEXT PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS moves (
+        old_path TEXT PRIMARY KEY,
+        new_path TEXT NOT NULL
+    );
+    """
+
+    _instances: dict[str, "MetadataStore"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path: str | pathlib.Path):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(self.SCHEMA)
+        self._migrate()
+        self._connection.commit()
+        self._rows: dict[str, tuple[tuple[int, int, int], str, str | None]] = {}
+        self._folders: dict[str, tuple[str, str]] = {}
+        self._load()
+
+    def _migrate(self):
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(probes)")}
+        if "fingerprint" not in columns:
+            logger.info("Adding content fingerprints to %s", self.path)
+            self._connection.execute("ALTER TABLE probes ADD COLUMN fingerprint TEXT")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS probes_fingerprint ON probes (fingerprint)")
+
+    def _load(self):
+        cursor = self._connection.execute("SELECT path, size, mtime, inode, data, fingerprint FROM probes")
+        self._rows = {
+            path: ((size, mtime, inode), data, fingerprint)
+            for path, size, mtime, inode, data, fingerprint in cursor
+        }
+        cursor = self._connection.execute("SELECT path, fingerprint, data FROM folders")
+        self._folders = {
+            path: (fingerprint, data)
+            for path, fingerprint, data in cursor
+        }
+        logger.info("Loaded %d metadata entries and %d folders from %s", len(self._rows), len(self._folders), self.path)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, key: str) -> bool:
+        return self._get_row(key) is not None
+
+    def _get_row(self, key: str, stat: os.stat_result | None = None) -> tuple[tuple[int, int, int], str, str | None] | None:
+        """Return the entry at `key` from memory. If it is missing, or does not
+        match `stat`, read it again from the database, as another process
+        (such as a scan, or another server worker) may have written it.
+        """
+        row = self._rows.get(key)
+        if row is not None and (stat is None or row[0] == stat_signature(stat)):
+            return row
+        with self._lock:
+            result = self._connection.execute(
+                "SELECT size, mtime, inode, data, fingerprint FROM probes WHERE path = ?",
+                (key,)).fetchone()
+            if result is None:
+                self._rows.pop(key, None)
+                return None
+            size, mtime, inode, data, fingerprint = result
+            row = ((size, mtime, inode), data, fingerprint)
+            self._rows[key] = row
+        return row
+
+    def get(self, key: str, stat: os.stat_result) -> dict | None:
+        """Return the stored probe for the media at `key` (path relative to
+        the library root), or None if it is missing or stale.
+        """
+        row = self._get_row(key, stat)
+        if row is None:
+            return None
+        signature, data, _ = row
+        if signature != stat_signature(stat):
+            logger.info("Metadata entry for %s is stale", key)
+            return None
+        return json.loads(data)
+
+    def is_fresh(self, key: str, stat: os.stat_result) -> bool:
+        row = self._get_row(key, stat)
+        return row is not None and row[0] == stat_signature(stat)
+
+    def get_fingerprint(self, key: str) -> str | None:
+        row = self._get_row(key)
+        return None if row is None else row[2]
+
+    def put(self, key: str, stat: os.stat_result, probe: dict, fingerprint: str | None = None):
+        signature = stat_signature(stat)
+        data = json.dumps(probe)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO probes (path, size, mtime, inode, data, fingerprint) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, *signature, data, fingerprint))
+            self._connection.commit()
+            self._rows[key] = (signature, data, fingerprint)
+
+    def discard(self, key: str) -> bool:
+        """Delete the entry at `key`. Return False if there was none, which
+        lets concurrent scans, even from other processes, claim an entry only
+        once.
+        """
+        with self._lock:
+            self._rows.pop(key, None)
+            cursor = self._connection.execute("DELETE FROM probes WHERE path = ?", (key,))
+            self._connection.commit()
+            return cursor.rowcount > 0
+
+    def find(self, fingerprint: str) -> list[tuple[str, dict]]:
+        """Return the keys and probes of the entries with the given content
+        fingerprint.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT path, data FROM probes WHERE fingerprint = ?",
+                (fingerprint,)).fetchall()
+        return [(key, json.loads(data)) for key, data in rows]
+
+    def add_move(self, old_key: str, new_key: str):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO moves (old_path, new_path) VALUES (?, ?)",
+                (old_key, new_key))
+            self._connection.commit()
+
+    def pop_moves(self) -> list[tuple[str, str]]:
+        """Return and forget the recorded moves, in the order they occurred.
+        """
+        with self._lock:
+            moves = self._connection.execute("SELECT old_path, new_path FROM moves ORDER BY rowid").fetchall()
+            self._connection.execute("DELETE FROM moves")
+            self._connection.commit()
+        return moves
+
+    def get_folder(self, key: str, fingerprint: str) -> dict | None:
+        """Return the stored library folder at `key` if it was scanned when the
+        directory had the same fingerprint, None otherwise.
+        """
+        row = self._folders.get(key)
+        if row is None or row[0] != fingerprint:
+            # The folder may have been scanned by another process
+            with self._lock:
+                row = self._connection.execute(
+                    "SELECT fingerprint, data FROM folders WHERE path = ?",
+                    (key,)).fetchone()
+                if row is None:
+                    return None
+                self._folders[key] = row
+            if row[0] != fingerprint:
+                return None
+        return json.loads(row[1])
+
+    def put_folder(self, key: str, fingerprint: str, folder: dict):
+        data = json.dumps(folder)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO folders (path, fingerprint, data) VALUES (?, ?, ?)",
+                (key, fingerprint, data))
+            self._connection.commit()
+            self._folders[key] = (fingerprint, data)
+
+    def prune(self, keys: set[str], folder_keys: set[str] | None = None):
+        """Delete every media entry whose key is not in `keys`, and every
+        folder entry whose key is not in `folder_keys`, if given.
+        """
+        with self._lock:
+            stale = [key for key in self._rows if key not in keys]
+            stale_folders = [] if folder_keys is None else [key for key in self._folders if key not in folder_keys]
+            if not stale and not stale_folders:
+                return
+            logger.info("Pruning %d metadata entries and %d folders", len(stale), len(stale_folders))
+            self._connection.executemany("DELETE FROM probes WHERE path = ?", [(key,) for key in stale])
+            self._connection.executemany("DELETE FROM folders WHERE path = ?", [(key,) for key in stale_folders])
+            self._connection.commit()
+            for key in stale:
+                self._rows.pop(key, None)
+            for key in stale_folders:
+                self._folders.pop(key, None)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    @staticmethod
+    def get_path(settings: Settings) -> pathlib.Path:
+        if settings.metadata_path is not None:
+            return pathlib.Path(settings.metadata_path)
+        return pathlib.Path(settings.library_root) / settings.hidden_directory / "metadata.sqlite3"
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "MetadataStore":
+        """Return the store for the current library, opening it only once per
+        process.
+        """
+        path = str(cls.get_path(settings).absolute())
+        with cls._instances_lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path)
+            return cls._instances[path]
@@ -12,6 +12,7 @@ import pathlib
 import sys
 import urllib.parse
 
+from .events import EventBus
 from .library import Library, Media, SUBTITLE_TRACK, SUBTITLE_FILE, SubtitleTrack, SubtitleFile
 from .settings import Settings
 
@@ -143,9 +144,15 @@ class Player:
     STATE_ENDED = 6
     STATE_ERROR = 7
 
+    EVENT_TIME_CHANGED = "time_changed"
+    EVENT_STATE_CHANGED = "state_changed"
+    EVENT_MEDIA_CHANGED = "media_changed"
+    EVENT_BUFFERING = "buffering"
+
     def __init__(self, settings: Settings):
         self.settings = settings
         self.observers: set[PlayerObserver] = set()
+        self.events = EventBus(self._handle_event, {self.EVENT_TIME_CHANGED})
         self.fastforward_seconds: int = settings.default_fastforward_seconds
         self.rewind_seconds: int = settings.default_rewind_seconds
         self.subs_delay_step_ms: float = settings.default_subs_delay_step_milliseconds
@@ -189,6 +196,12 @@ class Player:
             return None
         return self.vlc_media_player.get_time()
 
+    @property
+    def rate(self) -> float:
+        if self.vlc_media_player is None:
+            return 1
+        return self.vlc_media_player.get_rate()
+
     @property
     def state(self) -> int | None:
         if self.vlc_media_player is None:
@@ -209,61 +222,72 @@ class Player:
         self.vlc_media_player.set_fullscreen(1)
         self.volume(self.default_volume)
         self.aspect_ratio(self.default_aspect_ratio)
+        self.events.start()
         self.attach_events()
 
     def attach_events(self):
-        def on_time_changed(event, player):
-            logger.debug("Event fired: time changed to %d", event.u.new_time)
-            for observer in self.observers:
-                observer.on_time_changed(event.u.new_time)
-            if self._playback_begins:
-                self.on_playback_begins()
-                self._playback_begins = False
+        # Callbacks are called from the libvlc event thread, and only publish
+        # events to the bus. Note that the bindings keep a single callback per
+        # event type.
         assert self.vlc_event_manager is not None
         self.vlc_event_manager.event_attach(
             VlcEvent.MediaPlayerTimeChanged,
-            on_time_changed,
+            lambda event, player: self.events.publish(self.EVENT_TIME_CHANGED, event.u.new_time),
             self.vlc_media_player
         )
         state_event_types = (
             VlcEvent.MediaPlayerOpening,
-            VlcEvent.MediaPlayerBuffering,
             VlcEvent.MediaPlayerPlaying,
             VlcEvent.MediaPlayerPaused,
             VlcEvent.MediaPlayerStopped,
             VlcEvent.MediaPlayerEndReached,
         )
         for event_type in state_event_types:
-            def callback(event, player):
-                logger.info("Event fired: state changed to %s (old state is %s)", get_state_name(self.state), get_state_name(self._old_state))
-                new_state = self.state
-                if self._old_state == new_state:
-                    return
-                self._old_state = new_state
-                for observer in self.observers:
-                    observer.on_media_state_changed(new_state)
-            self.vlc_event_manager.event_attach(event_type, callback, self.vlc_media_player)
-        def on_media_changed(event, player):
-            logger.info("Event fired: media changed to %s", self.media_path)
-            for observer in self.observers:
-                observer.on_media_changed(self.media_path)
+            self.vlc_event_manager.event_attach(
+                event_type,
+                lambda event, player: self.events.publish(self.EVENT_STATE_CHANGED),
+                self.vlc_media_player)
         self.vlc_event_manager.event_attach(
             VlcEvent.MediaPlayerMediaChanged,
-            on_media_changed,
+            lambda event, player: self.events.publish(self.EVENT_MEDIA_CHANGED),
             self.vlc_media_player
         )
-        def onbuffering(event, player):
+        self.vlc_event_manager.event_attach(
+            VlcEvent.MediaPlayerBuffering,
+            lambda event, player: self.events.publish(self.EVENT_BUFFERING),
+            self.vlc_media_player
+        )
+
+    def _handle_event(self, kind: str, value):
+        """Handle an event from the bus, in the dispatcher thread.
+        """
+        observers = list(self.observers)
+        if kind == self.EVENT_TIME_CHANGED:
+            logger.debug("Event fired: time changed to %d", value)
+            for observer in observers:
+                observer.on_time_changed(value)
+            if self._playback_begins:
+                self.on_playback_begins()
+                self._playback_begins = False
+        elif kind == self.EVENT_STATE_CHANGED:
+            logger.info("Event fired: state changed to %s (old state is %s)", get_state_name(self.state), get_state_name(self._old_state))
+            new_state = self.state
+            if self._old_state == new_state:
+                return
+            self._old_state = new_state
+            for observer in observers:
+                observer.on_media_state_changed(new_state)
+        elif kind == self.EVENT_MEDIA_CHANGED:
+            logger.info("Event fired: media changed to %s", self.media_path)
+            for observer in observers:
+                observer.on_media_changed(self.media_path)
+        elif kind == self.EVENT_BUFFERING:
             logger.debug("Event fired: media player is buffering, _waiting_to_play is %s", self._waiting_to_play)
             assert self.vlc_media_player is not None
             if self._waiting_to_play:
                 self.vlc_media_player.play()
                 self._playback_begins = True
                 self._waiting_to_play = False
-        self.vlc_event_manager.event_attach(
-            VlcEvent.MediaPlayerBuffering,
-            onbuffering,
-            self.vlc_media_player
-        )
 
     def on_playback_begins(self):
         logger.info("Playback begins")
@@ -459,6 +483,7 @@ class Player:
 
     def close(self):
         logger.debug("Closing player")
+        self.events.close()
         try:
             if self.vlc_media_player is not None:
                 # NOTE: for some reason, realeasing the player here
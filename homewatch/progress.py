@@ -0,0 +1,148 @@
+"""Watch progress aggregated per library folder.
+
+The aggregates of every folder (total duration and progress, number of done
+and unstarted medias, over its whole subtree) are computed once from the
+history, then updated along the path to the root whenever the progress of a
+media changes. When library folders are scanned again, only their subtrees
+are computed again.
+"""
+
+import dataclasses
+import logging
+import pathlib
+import threading
+
+from .history import History, SqliteHistory
+from .library import Library, Media
+from .settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_media_done(settings: Settings, progress: int, duration_ms: int) -> bool:
+    return progress > 0\
+        and duration_ms > 0\
+        and progress >= duration_ms - settings.mark_as_viewed_threshold_seconds * 1000\
+        and progress / duration_ms >= settings.mark_as_viewed_threshold_ratio
+
+
+@dataclasses.dataclass
+class FolderProgress:
+
+    duration: int = 0
+    progress: int = 0
+    medias: int = 0
+    done_medias: int = 0
+    unstarted_medias: int = 0
+
+    def is_done(self, settings: Settings) -> bool:
+        return is_media_done(settings, self.progress, self.duration)
+
+    def is_unstarted(self) -> bool:
+        return self.progress == 0
+
+
+class ProgressTree:
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self._lock = threading.Lock()
+        self._folders: dict[str, FolderProgress] = {}
+        self._parents: dict[str, str | None] = {}
+        # Folder, duration and progress of each media, by path
+        self._medias: dict[str, tuple[str, int, int]] = {}
+        # Paths of the medias directly within each folder
+        self._folder_medias: dict[str, list[str]] = {}
+
+    def build(self, library: Library, history: History | SqliteHistory):
+        """Compute the aggregates of every folder of the library.
+        """
+        with self._lock:
+            # The history is read under the lock, so that concurrent updates
+            # are either in it or applied to the new tree afterwards
+            progresses = history.to_dict()
+            self._folders, self._parents, self._medias, self._folder_medias = {}, {}, {}, {}
+            self._add_folders(library, list(library), lambda media: progresses.get(media.path.as_posix(), 0))
+        logger.info("Computed progress of %d folders", len(self._folders))
+
+    def refresh(self, library: Library, keys: set[str], history: History | SqliteHistory):
+        """Compute again the aggregates of the folders at `keys` (paths
+        relative to the library root) and of their subfolders, after they were
+        scanned again.
+        """
+        prefixes = tuple(key + "/" for key in keys if key != ".")
+        affected = lambda other: other in keys or "." in keys or other.startswith(prefixes)
+        with self._lock:
+            removed = [key for key in self._folders if affected(key)]
+            for key in removed:
+                for path in self._folder_medias.pop(key, []):
+                    _, duration, progress = self._medias.pop(path)
+                    self._apply(
+                        key,
+                        -duration,
+                        -progress,
+                        -1,
+                        -int(is_media_done(self.settings, progress, duration)),
+                        -int(progress == 0))
+            for key in removed:
+                del self._folders[key]
+                del self._parents[key]
+            added = sorted((key for key in library if affected(key)), key=lambda k: k.count("/"))
+            self._add_folders(library, added, lambda media: history[media])
+        logger.info("Computed progress of %d folders again", len(added))
+
+    def _add_folders(self, library: Library, keys: list[str], get_progress):
+        for key in keys:
+            self._folders[key] = FolderProgress()
+            self._parents[key] = None if key == "." else pathlib.PurePosixPath(key).parent.as_posix()
+        for key in keys:
+            self._folder_medias[key] = []
+            for media in library[key].medias:
+                path = media.path.as_posix()
+                self._medias[path] = (key, media.duration_ms, 0)
+                self._folder_medias[key].append(path)
+                self._apply(key, media.duration_ms, 0, 1, 0, 1)
+                self._set(path, get_progress(media))
+
+    def _apply(self, key: str | None, duration: int, progress: int, medias: int, done_medias: int, unstarted_medias: int):
+        while key is not None and key in self._folders:
+            folder = self._folders[key]
+            folder.duration += duration
+            folder.progress += progress
+            folder.medias += medias
+            folder.done_medias += done_medias
+            folder.unstarted_medias += unstarted_medias
+            key = self._parents[key]
+
+    def _set(self, path: str, progress: int):
+        key, duration, previous = self._medias[path]
+        self._medias[path] = (key, duration, progress)
+        self._apply(
+            key,
+            0,
+            progress - previous,
+            0,
+            int(is_media_done(self.settings, progress, duration)) - int(is_media_done(self.settings, previous, duration)),
+            int(progress == 0) - int(previous == 0))
+
+    def update(self, media: Media, progress: int):
+        """Set the progress of a media, and update the aggregates of its
+        folder and of every folder above.
+        """
+        with self._lock:
+            if media.path.as_posix() in self._medias:
+                self._set(media.path.as_posix(), progress)
+
+    def get_media(self, media: Media) -> int:
+        with self._lock:
+            entry = self._medias.get(media.path.as_posix())
+        return 0 if entry is None else entry[2]
+
+    def get(self, key: str) -> FolderProgress:
+        """Return a copy of the aggregates of the folder at `key` (path relative
+        to the library root, in POSIX form).
+        """
+        with self._lock:
+            folder = self._folders.get(key)
+            return FolderProgress() if folder is None else dataclasses.replace(folder)
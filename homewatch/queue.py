@@ -1,8 +1,16 @@
 """Implementation of a media player queue. This offers features such as adding
 elements for the future, shift elements from the future to the past, shuffling
 and serialization.
+
+The ordering of the queue is never materialized: it is made of segments, one
+per batch of added elements, each of which is either in order or shuffled by a
+seeded permutation. The element at a position, and the position of an
+element, are computed on demand, so that shuffling a queue of any size takes
+constant memory and can be reproduced from the seeds.
 """
 
+import bisect
+import dataclasses
 import logging
 import random
 
@@ -25,42 +33,195 @@ class EndOfQueueException(Exception):
     pass
 
 
+MASK64 = (1 << 64) - 1
+
+
+def mix64(x: int) -> int:
+    """Finalizer of the SplitMix64 generator, a cheap 64 bits hash."""
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9 & MASK64
+    x = (x ^ (x >> 27)) * 0x94d049bb133111eb & MASK64
+    return x ^ (x >> 31)
+
+
+class Permutation:
+    """Seeded bijection over `range(length)`, computed one index at a time.
+
+    This is a balanced Feistel network over the smallest domain of 4^k
+    integers containing the range, which is a bijection whatever its round
+    function is. Values falling outside of the range are encrypted again
+    (cycle walking) until they fall inside, which takes less than four
+    encryptions on average since the domain is less than four times the range.
+    """
+
+    ROUNDS = 4
+
+    def __init__(self, length: int, seed: int):
+        self.length = length
+        self.half_bits = max(1, (max(0, length - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half_bits) - 1
+        self.keys = [mix64((seed + i * 0x9e3779b97f4a7c15) & MASK64) for i in range(self.ROUNDS)]
+
+    def _encrypt(self, x: int) -> int:
+        left, right = x >> self.half_bits, x & self.mask
+        for key in self.keys:
+            left, right = right, left ^ (mix64(right ^ key) & self.mask)
+        return (left << self.half_bits) | right
+
+    def _decrypt(self, x: int) -> int:
+        left, right = x >> self.half_bits, x & self.mask
+        for key in reversed(self.keys):
+            left, right = right ^ (mix64(left ^ key) & self.mask), left
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, i: int) -> int:
+        x = self._encrypt(i)
+        while x >= self.length:
+            x = self._encrypt(x)
+        return x
+
+    def index(self, x: int) -> int:
+        """Inverse of the permutation."""
+        i = self._decrypt(x)
+        while i >= self.length:
+            i = self._decrypt(i)
+        return i
+
+
+@dataclasses.dataclass
+class Segment:
+    """Positions `[start, start + length)` of the queue, holding the elements
+    with the same indices. If `seed` is not None, they are shuffled, the
+    permutation being rotated by `offset`.
+    """
+
+    start: int
+    length: int
+    seed: int | None = None
+    offset: int = 0
+
+    def __post_init__(self):
+        self._permutation = None if self.seed is None else Permutation(self.length, self.seed)
+
+    def to_dict(self) -> dict:
+        return {"start": self.start, "length": self.length, "seed": self.seed, "offset": self.offset}
+
+    def get_index(self, position: int) -> int:
+        if self._permutation is None:
+            return position
+        return (self._permutation[position - self.start] + self.offset) % self.length + self.start
+
+    def get_position(self, index: int) -> int:
+        if self._permutation is None:
+            return index
+        return self._permutation.index((index - self.start - self.offset) % self.length) + self.start
+
+    @classmethod
+    def shuffled(cls, start: int, length: int, position: int | None = None, index: int | None = None) -> "Segment":
+        """Create a segment with a random seed, putting the element at `index`
+        at `position` if both are given.
+        """
+        segment = cls(start, length, random.getrandbits(63))
+        if position is not None and index is not None:
+            segment.offset = (index - start) - segment._permutation[position - start]
+            segment.offset %= length
+        return segment
+
+
+def find_segment(segments: list[Segment], i: int) -> Segment:
+    """Return the segment holding position `i`, which is also the segment
+    holding the element at index `i`.
+    """
+    return segments[bisect.bisect_right(segments, i, key=lambda s: s.start) - 1]
+
+
 class Queue:
     """Generic Queue class. Elements can be added with the `.add` method. Call
     the `.next` method to load the next element. Elements can be accessed via
-    their indices through brackets.
+    their position in the queue through brackets.
     """
 
-    def __init__(self, default_shuffle: bool, default_loop: bool):
+    def __init__(self, default_shuffle: bool, default_loop: bool, window_size: int = 50):
         self.elements: list[Media] = []
-        self.ordering: list[int] = []
+        self.segments: list[Segment] = []
         self.current: int | None = None
         self.shuffle: bool = default_shuffle
         self.loop: bool = default_loop
-    
-    def to_dict(self) -> dict:
+        self.window_size: int = window_size
+        # Index of elements by path, in POSIX form
+        self._index: dict[str, int] = {}
+
+    def get_window(self) -> tuple[int, int]:
+        """Return the offset and the length of the window of positions
+        centered on the current element.
+        """
+        current = 0 if self.current is None else self.current
+        offset = max(0, min(current - self.window_size // 2, len(self) - self.window_size))
+        return offset, self.window_size
+
+    def to_dict(self, offset: int | None = None, limit: int | None = None) -> dict:
+        """
+        @param offset: position of the first element to serialize, defaults
+            to the start of the window around the current element
+        @param limit: maximum number of elements to serialize, defaults to the
+            window size
+        """
+        if offset is None:
+            offset = self.get_window()[0]
+        if limit is None:
+            limit = self.window_size
+        offset = max(0, offset)
         return {
-            "elements": [x.to_mindict() for x in self.elements],
-            "ordering": self.ordering,
+            "elements": [x.to_mindict() for x in self[offset:offset + max(0, limit)]],
+            "offset": offset,
+            "length": len(self),
             "current": self.current,
             "shuffle": self.shuffle,
             "loop": self.loop,
         }
-    
-    def _ordered_elements(self) -> list[Media]:
-        return [self.elements[i] for i in self.ordering]
-    
+
     def __len__(self) -> int:
         return len(self.elements)
 
     def __str__(self):
-        elements = list(map(str, self._ordered_elements()))
+        elements = list(map(str, self[:]))
         if self.current is not None:
             elements[self.current] = f"*{elements[self.current]}"
         return "[" + ", ".join(elements) + "]"
 
     def __getitem__(self, key: int | slice) -> Media | list[Media]:
-        return self._ordered_elements()[key]
+        if isinstance(key, slice):
+            return [self.elements[self.get_index(i)] for i in range(len(self))[key]]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(f"Queue position out of range: {key}")
+        return self.elements[self.get_index(key)]
+
+    def get_index(self, position: int) -> int:
+        """Return the index in `elements` of the element at `position`."""
+        return find_segment(self.segments, position).get_index(position)
+
+    def get_position(self, index: int) -> int:
+        """Return the position of the element at `index` in `elements`."""
+        return find_segment(self.segments, index).get_position(index)
+
+    def _extend(self, elements: list[Media]) -> int:
+        i0 = len(self.elements)
+        for i, media in enumerate(elements, start=i0):
+            self._index.setdefault(media.path.as_posix(), i)
+        self.elements += elements
+        return i0
+
+    def _reorder(self, position: int | None = None, index: int | None = None):
+        """Replace the segments with a single one, shuffled with a new seed
+        if shuffle is enabled.
+        """
+        if not self.elements:
+            self.segments = []
+        elif self.shuffle:
+            self.segments = [Segment.shuffled(0, len(self.elements), position, index)]
+        else:
+            self.segments = [Segment(0, len(self.elements))]
 
     def add(self, elements: list[Media], first_index: int | None = 0,
             clear_first: bool = True):
@@ -68,51 +229,45 @@ class Queue:
                     len(elements), first_index, clear_first)
         if clear_first:
             self.elements = []
-            self.ordering = []
+            self.segments = []
             self.current = None
-        self.elements += elements
-        i0 = len(self.ordering)
-        new_ordering = list(range(i0, i0 + len(elements)))
+            self._index = {}
+        i0 = self._extend(elements)
         if self.shuffle:
-            random.shuffle(new_ordering)
-        if self.shuffle:
-            if first_index is not None:
-                new_ordering[new_ordering.index(i0 + first_index)] = new_ordering[0]
-                new_ordering[0] = i0 + first_index
+            if elements:
+                self.segments.append(Segment.shuffled(i0, len(elements), i0, None if first_index is None else i0 + first_index))
             self.current = i0
-        elif first_index is not None:
-            self.current = i0 + first_index
         else:
-            self.current = i0
-        self.ordering += new_ordering
-    
+            if elements:
+                self.segments.append(Segment(i0, len(elements)))
+            self.current = i0 if first_index is None else i0 + first_index
+
     def append(self, elements: list[Media]):
         logger.info("Appending %d elements", len(elements))
-        self.ordering += list(range(len(self.ordering), len(self.ordering) + len(elements)))
-        self.elements += elements
-            
+        i0 = self._extend(elements)
+        if not elements:
+            return
+        if self.segments and self.segments[-1].seed is None:
+            self.segments[-1].length += len(elements)
+        else:
+            self.segments.append(Segment(i0, len(elements)))
+
     def set_shuffle(self, shuffle: bool):
         logger.info("Setting shuffle to %s", shuffle)
         self.shuffle = shuffle
-        i = None if self.current is None else self.ordering[self.current]
-        if self.shuffle:
-            random.shuffle(self.ordering)
-        else:
-            self.ordering.sort()
-        self.current = None if i is None else self.ordering.index(i)
-    
+        i = None if self.current is None else self.get_index(self.current)
+        self._reorder()
+        self.current = None if i is None else self.get_position(i)
+
     def doloop(self):
         logger.info("Looping the queue")
         self.current = 0
-        if self.shuffle:
-            random.shuffle(self.ordering)
-        else:
-            self.ordering.sort()
+        self._reorder()
 
     def next(self):
         if self.current == len(self.elements) - 1 and self.loop:
             self.doloop()
-        elif self.current is not None and self.current < len(self.elements):
+        elif self.current is not None and self.current < len(self.elements) - 1:
             self.current += 1
         else:
             raise EndOfQueueException()
@@ -124,41 +279,84 @@ class Queue:
         else:
             raise StartOfQueueException()
         logger.info("Loading previous element in queue, current is %s", self.current)
-    
+
     @property
     def current_media(self) -> Media | None:
         if self.current is None:
             return None
-        return self.elements[self.ordering[self.current]]
-    
+        return self.elements[self.get_index(self.current)]
+
     def jump_to(self, index: int):
-        logger.info("Jumping to index %d", self.current)
+        if not 0 <= index < len(self.elements):
+            raise IndexError(f"Queue position out of range: {index}")
+        logger.info("Jumping to index %d", index)
         self.current = index
 
     def jump_to_media(self, media: Media):
         logger.info("Jumping to media at %s", media.path)
-        j = None
-        for i, target in enumerate(self.elements):
-            if media.path == target.path:
-                j = i
-                break
-        if j is not None:
-            self.jump_to(self.ordering.index(j))
+        i = self._index.get(media.path.as_posix())
+        if i is not None:
+            self.jump_to(self.get_position(i))
+
+    def resolve_elements(self, library: Library):
+        """Replace the elements with the medias at the same path in `library`,
+        after it was scanned or fetched again. Elements that are not in the
+        library anymore are kept as is.
+        """
+        resolved = 0
+        for i, media in enumerate(self.elements):
+            library_media = library.get_media(media.path)
+            if library_media is not None and library_media is not media:
+                self.elements[i] = library_media
+                resolved += 1
+        logger.debug("Resolved %d queue elements in the new library", resolved)
 
     @property
     def empty(self) -> bool:
         return not self.elements
-    
+
     def get_status_dict(self) -> dict:
-        return self.to_dict()
-    
+        return {
+            "elements": [x.to_mindict() for x in self.elements],
+            "segments": [segment.to_dict() for segment in self.segments],
+            "current": self.current,
+            "shuffle": self.shuffle,
+            "loop": self.loop,
+        }
+
     def load_status_dict(self, status: dict, library: Library):
-        self.elements = []
-        for media_dict in status.get("elements", []):
-            media = library.get_media2(media_dict["basename"], media_dict["folder"])
-            if media is not None:
-                self.elements.append(media)
-        self.ordering = status.get("ordering", self.ordering)
-        self.current = status.get("current", self.current)
         self.shuffle = status.get("shuffle", self.shuffle)
         self.loop = status.get("loop", self.loop)
+        elements: list[Media] = []
+        # Index of stored elements in the loaded elements, as some medias may
+        # not be in the library anymore
+        indices: dict[int, int] = {}
+        stored_elements = status.get("elements", [])
+        for i, media_dict in enumerate(stored_elements):
+            media = library.get_media2(media_dict["basename"], media_dict["folder"])
+            if media is not None:
+                indices[i] = len(elements)
+                elements.append(media)
+        self.elements = []
+        self._index = {}
+        self._extend(elements)
+        current = status.get("current")
+        if "segments" in status and len(elements) == len(stored_elements):
+            self.segments = [Segment(**segment) for segment in status["segments"]]
+            self.current = current if current is not None and 0 <= current < len(self) else None
+            return
+        # The stored ordering can not be restored: keep the current element,
+        # and order or shuffle the queue again around it
+        current_index = None
+        if current is not None and 0 <= current < len(stored_elements) and "segments" in status:
+            segments = [Segment(**segment) for segment in status["segments"]]
+            current_index = find_segment(segments, current).get_index(current)
+        elif current is not None and 0 <= current < len(status.get("ordering", [])):
+            current_index = status["ordering"][current]
+        if current_index in indices:
+            position = min(current, len(elements) - 1)
+            self._reorder(position, indices[current_index])
+            self.current = position if self.shuffle else indices[current_index]
+        else:
+            self._reorder()
+            self.current = None
@@ -1,6 +1,10 @@
 import asyncio
+import dataclasses
+import datetime
+import hashlib
 import json
 import logging
+import mimetypes
 import os
 import pathlib
 import subprocess
@@ -8,20 +12,33 @@ import threading
 import time
 import traceback
 import urllib.parse
+import zlib
+from typing import Iterable, Iterator
 
 import jinja2
 import qrcode
 import websockets
 import werkzeug
+import werkzeug.http
+import werkzeug.security
 import werkzeug.middleware.shared_data
 import werkzeug.serving
+import werkzeug.utils
 from websockets.asyncio.connection import Connection
 
-from .library import LibraryFolder, Hierarchy, Media
+from .asyncserver import AsyncioServer, WebsocketConnection, WEBSOCKET_PATH
+from .cache import HierarchyCache, LibraryCache, LibraryFolderCache
+from .compression import CompressionMiddleware
+from .library import DirectoryListing, Library, LibraryFolder, Hierarchy, Media, get_media_type_string, get_probe_media_type_string
+from .metadata import MetadataStore
 from .theater import Theater
+from .thumbnails import ThumbnailService
 from .player import Player, PlayerObserver
+from .watcher import LibraryWatcher
 from .web import WebPlayer, WebPlayerObserver
 from .settings import Settings, ChromecastGeneration
+from .streaming import send_media_file
+from .sync import StateSync, TOPICS
 
 
 logger = logging.getLogger(__name__)
@@ -29,6 +46,12 @@ logger = logging.getLogger(__name__)
 
 BASEDIR = pathlib.Path(__file__).parent
 
+THUMBNAIL_MIMETYPES = {
+    ".jpg": "image/jpeg",
+    ".webp": "image/webp",
+    ".avif": "image/avif",
+}
+
 
 def urljoin(base: str, *parts: str) -> str:
     if not parts:
@@ -38,6 +61,48 @@ def urljoin(base: str, *parts: str) -> str:
     return urllib.parse.urljoin(base, url)
 
 
+def thumbnail_srcset(settings: Settings, format: str, *parts: str) -> str:
+    """Build the srcset of a thumbnail in the given format, with one candidate
+    per pixel density. URLs are quoted, since whitespace separates candidates.
+    """
+    url = urllib.parse.quote(urljoin(settings.thumbnail_url, *parts), safe=":/")
+    return ", ".join(
+        f"{url}?format={format}&density={density} {density}x"
+        for density in settings.thumbnail_densities)
+
+
+def iter_library_json(library: Library) -> Iterator[bytes]:
+    """Serialize the library folder by folder, so that it can be streamed.
+    """
+    yield ('{"root": ' + json.dumps(str(library.root)) + ', "folders": [').encode("utf8")
+    for i, library_folder in enumerate(list(library.values())):
+        yield ((", " if i > 0 else "") + json.dumps(library_folder.to_dict())).encode("utf8")
+    yield b"]}"
+
+
+def get_etag_salt(settings: Settings) -> str:
+    """Rendered pages also depend on the templates and the settings, which may
+    change between runs. The salt is derived from their contents, so that it is
+    the same in every worker process and across restarts.
+    """
+    digest = hashlib.sha1()
+    for path in sorted((BASEDIR / "templates").rglob("*")):
+        if path.is_file():
+            digest.update(path.relative_to(BASEDIR).as_posix().encode())
+            digest.update(path.read_bytes())
+    digest.update(json.dumps(dataclasses.asdict(settings), sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def iter_gzip(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
 def parse_qs(url: str) -> dict[str, None | str | list[str]]:
     query: dict[str, None | str | list[str]] = {}
     for key, value in urllib.parse.parse_qs(urllib.parse.urlparse(url)[4]).items():
@@ -85,10 +150,11 @@ class WebsocketServer(threading.Thread, PlayerObserver, WebPlayerObserver):
         self.server = server
         self.host = host
         self.port = port
-        self._clients: dict[tuple[str, int], Connection] = {}
+        self._clients: dict[tuple[str, int], Connection | WebsocketConnection] = {}
         self._stop_event: asyncio.Event | None = None
         self._ws: websockets.Server | None = None # type: ignore
         self._loop: asyncio.AbstractEventLoop | None = None
+        self._attached = False
         self.theater = self.server.theater
         self.player = self.server.theater.player
         self.close_on_end = self.server.settings.default_close_on_end
@@ -96,40 +162,103 @@ class WebsocketServer(threading.Thread, PlayerObserver, WebPlayerObserver):
         self.player.bind_observer(self)
         self.sleep_watcher = SleepWatcher(self)
         self.sleep_watcher.start()
-        self._previous_time_broadcast: int | None = None
+        # Time, monotonic clock and rate of the last time anchor
+        self._anchor: tuple[int, float, float] | None = None
+        self.sync = StateSync({
+            "player": self.server.get_player_state,
+            "queue": self.theater.queue.to_dict,
+            "media": self.server.get_media_state,
+        }, self._send)
+
+    def _get_anchor_message(self, new_time: int | None) -> tuple[str, tuple[int, float, float]]:
+        state = self.player.state
+        rate = self.player.rate if state == Player.STATE_PLAYING else 0
+        current_time = max(0, new_time or 0)
+        message = "ANCH " + json.dumps({
+            "time": current_time,
+            "at": int(time.time() * 1000),
+            "rate": rate,
+            "state": state,
+        })
+        return message, (current_time, time.monotonic(), rate)
+
+    def _broadcast_anchor(self, new_time: int | None):
+        message, self._anchor = self._get_anchor_message(new_time)
+        self._broadcast(message)
 
     def on_time_changed(self, new_time: int):
         if self.theater.waiting_screen_visible:
             return
-        if self._previous_time_broadcast is not None and new_time != 0 and abs(new_time - self._previous_time_broadcast) < self.server.settings.broadcast_time_delay_milliseconds:
-            logger.debug("Ignored time broadcast at time %d", new_time)
-            return
-        self._previous_time_broadcast = new_time
-        self._broadcast(f"TIME {new_time}")
+        if self._anchor is not None:
+            anchor_time, anchor_clock, rate = self._anchor
+            elapsed = time.monotonic() - anchor_clock
+            expected_time = anchor_time + elapsed * 1000 * rate
+            if abs(new_time - expected_time) <= self.server.settings.time_anchor_tolerance_milliseconds\
+                    and elapsed < self.server.settings.time_anchor_interval_seconds:
+                return
+        self._broadcast_anchor(new_time)
 
     def on_media_changed(self, media_path: str | None):
         if self.theater.waiting_screen_visible:
             return
-        self._broadcast(f"MPTH {media_path}")
+        self.sync.update("player", "media", "queue")
+        self._broadcast_anchor(0)
 
     def on_media_state_changed(self, new_state: int | None):
         logger.debug("Media state changed to %s. Waiting screen is %s.", new_state, "ON" if self.theater.waiting_screen_visible else "OFF")
         if self.theater.waiting_screen_visible:
             return
-        self._broadcast(f"MSTT {new_state}")
+        self.sync.update("player")
+        self._broadcast_anchor(self.player.time)
         if new_state == Player.STATE_ENDED and self.close_on_end:
             self.close()
 
-    def _run_coroutine(self, coro):
-        if not self._loop or self._loop.is_closed():
-            raise RuntimeError("Server is not running")
-        asyncio.run_coroutine_threadsafe(coro, self._loop)
-
     def _broadcast(self, message: str):
+        """Send a message to every client. It may be called from any thread,
+        the message is sent from the event loop.
+        """
         logger.debug("Broadcasting %s", message)
-        websockets.broadcast(self._clients.values(), message)
+        self._send(None, message)
+
+    def _send(self, keys: list | None, message: str):
+        """Send a message to the clients with the given keys, or to every
+        client if `keys` is None. It may be called from any thread, the message
+        is sent from the event loop.
+        """
+        if self._loop is None or self._loop.is_closed():
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._send_to_clients, keys, message)
+        except RuntimeError:
+            # The loop was closed in the meantime
+            pass
+
+    def _send_to_clients(self, keys: list | None, message: str):
+        if keys is None:
+            conns = list(self._clients.values())
+        else:
+            conns = [self._clients[key] for key in keys if key in self._clients]
+        if self._attached:
+            for conn in conns:
+                conn.send(message) # type: ignore
+        else:
+            websockets.broadcast(conns, message) # type: ignore
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Serve clients of the asyncio server running `loop`, instead of
+        running a separate websocket server.
+        """
+        self._loop = loop
+        self._attached = True
 
-    async def _on_client_message(self, conn: Connection, message: str | bytes):
+    def add_client(self, conn: Connection | WebsocketConnection):
+        self._clients[conn.remote_address] = conn
+
+    def remove_client(self, conn: Connection | WebsocketConnection):
+        self._clients.pop(conn.remote_address, None)
+        self.sync.unsubscribe(conn.remote_address)
+
+    def handle_message(self, conn: Connection | WebsocketConnection, message: str | bytes):
         logger.debug("Websocket %s \"%s\"", conn.remote_address, message)
         if not isinstance(message, str):
             return
@@ -148,13 +277,10 @@ class WebsocketServer(threading.Thread, PlayerObserver, WebPlayerObserver):
                 self.player.fastforward()
             case "SLAT":
                 self.player.subs_delay_later()
-                self._broadcast(f"SDEL {self.player.current_subs_delay}")
             case "SEAR":
                 self.player.subs_delay_earlier()
-                self._broadcast(f"SDEL {self.player.current_subs_delay}")
             case "SRST":
                 self.player.subs_delay_reset()
-                self._broadcast(f"SDEL {self.player.current_subs_delay}")
             case "STOP":
                 self.player.stop()
             case "VOLU":
@@ -185,11 +311,20 @@ class WebsocketServer(threading.Thread, PlayerObserver, WebPlayerObserver):
             case "JUMP":
                 self.theater.jump_to(int(args[0]))
             case "MEDI":
-                self._broadcast(f"MPTH {self.player.media_path}")
+                self.sync.subscribe(conn.remote_address, ["player", "media"])
+            case "SUBS":
+                topics = args[0].split(",") if args else []
+                self.sync.subscribe(conn.remote_address, topics)
+                if "player" in topics:
+                    self._send([conn.remote_address], self._get_anchor_message(self.player.time)[0])
             case "WEB":
                 self._on_client_message_web(conn, args[0], args[1:])
+        if cmd in ("PREV", "NEXT", "JUMP", "SHUF"):
+            self.sync.update("player", "queue")
+        elif cmd not in ("MEDI", "SUBS", "WEB", "PONG"):
+            self.sync.update("player")
 
-    def _on_client_message_web(self, conn: Connection, action: str, args: list[str]):
+    def _on_client_message_web(self, conn: Connection | WebsocketConnection, action: str, args: list[str]):
         if self.server.web_player is None:
             return
         if action == "close":
@@ -212,18 +347,18 @@ class WebsocketServer(threading.Thread, PlayerObserver, WebPlayerObserver):
         async def register(conn: Connection):
             key: tuple[str, int] = conn.remote_address
             logger.debug("New client %s:%d", key[0], key[1])
-            self._clients[key] = conn
+            self.add_client(conn)
             try:
                 async for message in conn:
                     try:
-                        await self._on_client_message(conn, message)
+                        self.handle_message(conn, message)
                     except Exception as err:
                         traceback.print_exc()
             except Exception:
                 pass
             finally:
                 logger.debug("Client %s:%d disconnected", key[0], key[1])
-                del self._clients[key]
+                self.remove_client(conn)
 
         self._ws = await websockets.serve(register, self.host, self.port)
         logger.info("Started server at ws://%s:%d", self.host, self.port)
@@ -271,18 +406,58 @@ class LibraryServer:
             url=lambda *x: urljoin(settings.home_url, *x),
             static=lambda *x: urljoin(settings.static_url, *x),
             media=lambda *x: urljoin(settings.media_url, *x),
+            thumbnail=lambda *x: urljoin(settings.thumbnail_url, *x),
             media_url=settings.media_url,
+            thumbnail_srcset=lambda format, *x: thumbnail_srcset(settings, format, *x),
+            thumbnail_url=settings.thumbnail_url,
+            thumbnail_formats=settings.thumbnail_formats,
             playermode=settings.server_mode == "player",
             enable_chromecast=settings.chromecast_generation != ChromecastGeneration.NONE,
             preferred_media_language_flag=settings.preferred_media_language_flag,
             first_library_load=True,
         )
+        self.thumbnails = ThumbnailService(settings)
+        self.folder_cache = LibraryFolderCache(settings.folder_cache_size, settings.folder_cache_ttl_seconds)
+        self.watcher: LibraryWatcher | None = None
+        if settings.library_watch and settings.library_mode == "local":
+            self.watcher = LibraryWatcher(settings, self.on_library_changed)
+            self.watcher.start()
+        self.hierarchy_cache = HierarchyCache(settings, watched=self.watcher is not None)
+        self.library_cache = LibraryCache(settings, watched=self.watcher is not None)
+        self.etag_salt = get_etag_salt(settings)
+        self.thumbnail_placeholder = (BASEDIR / "static" / "thumbnail-placeholder.svg").read_bytes()
 
     def _get_landing_redirection_target(self) -> str:
         return "library"
 
     def _get_library_folder(self, relpath: pathlib.Path) -> LibraryFolder | None:
-        return LibraryFolder.from_settings(self.settings, relpath.parent if relpath.name in {"index.html", "index.json"} else relpath)
+        folder_path = relpath.parent if relpath.name in {"index.html", "index.json"} else relpath
+        if self.settings.library_mode != "local" or self.settings.folder_cache_size <= 0:
+            return LibraryFolder.from_settings(self.settings, folder_path)
+        root = pathlib.Path(self.settings.library_root)
+        fullpath = root / folder_path
+        if not fullpath.resolve().is_relative_to(root.resolve()) or not fullpath.is_dir():
+            return LibraryFolder.from_settings(self.settings, folder_path)
+        listing = DirectoryListing.from_scan(root, folder_path, self.settings.hidden_directory)
+        key = folder_path.as_posix()
+        library_folder, stale_folder = self.folder_cache.get(key, listing.fingerprint)
+        if library_folder is None:
+            library_folder = LibraryFolder.from_scan(self.settings, root, folder_path, previous=stale_folder, listing=listing)
+            # The scan may have created the hidden directory
+            listing.refresh_mtime(root)
+            self.folder_cache.put(key, listing.fingerprint, library_folder)
+        return library_folder
+
+    def _get_library(self) -> Library | None:
+        if self.settings.library_mode != "local":
+            return None
+        return self.library_cache.get()
+
+    def _get_media(self, relpath: pathlib.Path) -> Media | None:
+        library_folder = self._get_library_folder(relpath.parent)
+        if library_folder is None:
+            return None
+        return library_folder.get_media(relpath.name)
 
     def view_landing(self, request: werkzeug.Request) -> werkzeug.Response:
         return werkzeug.Response("Found", status=302, mimetype="text/plain", headers={
@@ -304,20 +479,140 @@ class LibraryServer:
     def view_about(self, request: werkzeug.Request) -> werkzeug.Response:
         return self.view_basic("about.html")
 
+    def _get_folder_validators(self, relpath: pathlib.Path) -> tuple[str, datetime.datetime] | None:
+        """Return the fingerprint and the last modification date of the
+        library folder at `relpath`, read from a single directory listing, or
+        None if responses for this folder can not be validated.
+        """
+        if self.settings.library_mode != "local":
+            return None
+        root = pathlib.Path(self.settings.library_root)
+        folder_path = relpath.parent if relpath.name in {"index.html", "index.json"} else relpath
+        fullpath = root / folder_path
+        if not fullpath.resolve().is_relative_to(root.resolve()) or not fullpath.is_dir():
+            return None
+        listing = DirectoryListing.from_scan(root, folder_path, self.settings.hidden_directory)
+        mtime_ns = max([listing.mtime_ns] + [stat.st_mtime_ns for _, stat in listing.files])
+        return listing.fingerprint, datetime.datetime.fromtimestamp(mtime_ns / 1e9, datetime.timezone.utc)
+
+    def view_stats(self, request: werkzeug.Request) -> werkzeug.Response:
+        text = json.dumps({
+            "folder_cache": self.folder_cache.stats(),
+        })
+        return werkzeug.Response(text, status=200, mimetype="application/json")
+
     def view_library(self, request: werkzeug.Request) -> werkzeug.Response | None:
         relpath = pathlib.Path(request.path[1:]).relative_to("library/")
         query = parse_qs(request.url)
         embedded = query.get("embedded") == "1"
+        etag, last_modified = None, None
+        validators = self._get_folder_validators(relpath)
+        if validators is not None:
+            fingerprint, last_modified = validators
+            if relpath.name.endswith(".json"):
+                variant = "json"
+            else:
+                variant = f"html:{embedded}:{self.jinja.globals['first_library_load']}"
+            etag = hashlib.sha1(f"{self.etag_salt}:{fingerprint}:{variant}".encode()).hexdigest()
+            if not werkzeug.http.is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                return self._not_modified(etag, last_modified)
         library_folder = self._get_library_folder(relpath)
         if library_folder is None:
             return None
         if relpath.name.endswith(".json"):
             text = json.dumps(library_folder.to_dict())
-            return werkzeug.Response(text, status=200, mimetype="application/json")
-        template = self.jinja.get_template("library.html")
-        text = template.render(library=library_folder, embedded=embedded, subfolder_prefix="library")
-        self.jinja.globals.update(first_library_load=False)
-        return werkzeug.Response(text, status=200, mimetype="text/html")
+            response = werkzeug.Response(text, status=200, mimetype="application/json")
+        else:
+            template = self.jinja.get_template("library.html")
+            text = template.render(library=library_folder, embedded=embedded, subfolder_prefix="library")
+            self.jinja.globals.update(first_library_load=False)
+            response = werkzeug.Response(text, status=200, mimetype="text/html")
+        if etag is not None:
+            self._set_validators(response, etag, last_modified)
+        return response
+
+    def on_library_changed(self, keys: set[str]):
+        """
+        @param keys: paths of the changed folders, relative to the library root
+        """
+        self.hierarchy_cache.invalidate(keys)
+        self.library_cache.invalidate(keys)
+
+    def view_hierarchy(self, request: werkzeug.Request) -> werkzeug.Response:
+        if self.settings.library_mode == "local":
+            text, etag = self.hierarchy_cache.get()
+        else:
+            text = json.dumps(Hierarchy.from_settings(self.settings).to_dict()).encode("utf8")
+            etag = hashlib.sha1(text).hexdigest()
+        if not werkzeug.http.is_resource_modified(request.environ, etag=etag):
+            return self._not_modified(etag)
+        response = werkzeug.Response(text, status=200, mimetype="application/json")
+        self._set_validators(response, etag)
+        return response
+
+    def _set_validators(self, response: werkzeug.Response, etag: str, last_modified: datetime.datetime | None = None):
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        # Clients must revalidate instead of guessing a freshness lifetime
+        response.cache_control.no_cache = True
+
+    def _not_modified(self, etag: str, last_modified: datetime.datetime | None = None) -> werkzeug.Response:
+        response = werkzeug.Response(status=304)
+        self._set_validators(response, etag, last_modified)
+        return response
+
+    def view_library_bulk(self, request: werkzeug.Request) -> werkzeug.Response:
+        library = self._get_library()
+        if library is None:
+            return werkzeug.Response("404 Not Found", status=404, mimetype="text/plain")
+        if request.accept_encodings["gzip"]:
+            return werkzeug.Response(iter_gzip(iter_library_json(library)), status=200, mimetype="application/json", direct_passthrough=True, headers={
+                "Content-Encoding": "gzip",
+                "Vary": "Accept-Encoding",
+            })
+        return werkzeug.Response(iter_library_json(library), status=200, mimetype="application/json", direct_passthrough=True, headers={
+            "Vary": "Accept-Encoding",
+        })
+
+    def view_media(self, request: werkzeug.Request) -> werkzeug.Response:
+        if self.settings.library_mode != "local":
+            return werkzeug.Response("404 Not Found", status=404, mimetype="text/plain")
+        relpath = pathlib.PurePosixPath(request.path[1:]).relative_to("media/")
+        fullpath = werkzeug.security.safe_join(self.settings.library_root, relpath.as_posix())
+        if fullpath is None or not os.path.isfile(fullpath):
+            return werkzeug.Response("404 Not Found", status=404, mimetype="text/plain")
+        mimetype = None
+        # Media types derived from the probe are only accurate for these
+        # containers, others default to mp4. The probe is read from the
+        # metadata store, as seeking issues a request each time.
+        if relpath.suffix.lower() in {".mp4", ".webm", ".mkv"}:
+            probe = MetadataStore.from_settings(self.settings).get(relpath.as_posix(), os.stat(fullpath))
+            mimetype = get_media_type_string(relpath.suffix.lower(), None, None, None, None, None)\
+                if probe is None else get_probe_media_type_string(relpath.suffix, probe)
+        if mimetype is None:
+            mimetype = mimetypes.guess_type(relpath.name)[0] or "application/octet-stream"
+        return send_media_file(request.environ, pathlib.Path(fullpath), mimetype)
+
+    def view_thumbnail(self, request: werkzeug.Request) -> werkzeug.Response:
+        if self.settings.library_mode != "local":
+            return werkzeug.Response("404 Not Found", status=404, mimetype="text/plain")
+        relpath = pathlib.Path(request.path[1:]).relative_to("thumbnail/")
+        media = self._get_media(relpath)
+        if media is None:
+            return werkzeug.Response("404 Not Found", status=404, mimetype="text/plain")
+        path = pathlib.Path(self.settings.library_root) / media.path
+        density = request.args.get("density", 1, type=int)
+        format = request.args.get("format", "jpg")
+        if (format, density) != ("jpg", 1) and (format not in self.settings.thumbnail_formats or density not in self.settings.thumbnail_densities):
+            return werkzeug.Response("404 Not Found", status=404, mimetype="text/plain")
+        thumbnail_path = self.thumbnails.get(path, media.duration, self.settings.thumbnail_timeout_seconds, density, format)
+        if thumbnail_path is None:
+            return werkzeug.Response(self.thumbnail_placeholder, status=200, mimetype="image/svg+xml", headers={
+                "Cache-Control": "no-store"
+            })
+        mimetype = THUMBNAIL_MIMETYPES[thumbnail_path.suffix]
+        return werkzeug.utils.send_file(thumbnail_path, request.environ, mimetype=mimetype, max_age=86400)
 
     def dispatch_request(self, request: werkzeug.Request) -> werkzeug.Response | None:
         # TODO: enhance path resolution?
@@ -328,12 +623,18 @@ class LibraryServer:
             return werkzeug.Response("YES", status=200, mimetype="text/plain")
         elif str(path) == "about":
             return self.view_about(request)
+        elif str(path) == "stats":
+            return self.view_stats(request)
         elif path.is_relative_to("library/"):
             if str(path.relative_to("library/")) == "hierarchy.json":
-                hierarchy = Hierarchy.from_settings(self.settings)
-                text = json.dumps(hierarchy.to_dict())
-                return werkzeug.Response(text, status=200, mimetype="application/json")
+                return self.view_hierarchy(request)
+            if str(path.relative_to("library/")) == "library.json":
+                return self.view_library_bulk(request)
             return self.view_library(request)
+        elif path.is_relative_to("thumbnail/"):
+            return self.view_thumbnail(request)
+        elif path.is_relative_to("media/"):
+            return self.view_media(request)
         elif str(path) == "player":
             return self.view_player(request)
         return None
@@ -352,12 +653,16 @@ class LibraryServer:
 class PlayerServer(LibraryServer):
 
     def __init__(self, settings: Settings):
-        LibraryServer.__init__(self, settings)
+        # The theater is created first, as the library watcher started by the
+        # library server reports changes to it
         self.theater = Theater(settings)
+        LibraryServer.__init__(self, settings)
         self.wss = WebsocketServer(self, settings.server_host, 42012)
         self.hostname = settings.server_host
         self.port = settings.server_port
-        self.wss.start()
+        if settings.server_backend == "werkzeug":
+            # Otherwise, the asyncio server serves the websocket clients
+            self.wss.start()
         self.web_player: WebPlayer | None = None
         for hook_path in settings.pre_hooks:
             execute_hook(hook_path)
@@ -382,9 +687,14 @@ class PlayerServer(LibraryServer):
     def close(self, hooks: bool = True, restart: bool = False):
         logger.info("Closing server, hooks %s, restart %s", "ON" if hooks else "OFF", "ON" if restart else "OFF")
         self.export_status()
+        if self.watcher is not None:
+            self.watcher.close()
+        self.theater.save_library_snapshot(blocking=False)
         self.wss.close(False)
+        self.thumbnails.close()
         self.theater.close()
-        self.wss.join()
+        if self.wss.is_alive():
+            self.wss.join()
         if hooks:
             logger.debug("Post hooks are enabled: %s", ", ".join(self.settings.post_hooks))
             for hook_path in self.settings.post_hooks:
@@ -398,6 +708,21 @@ class PlayerServer(LibraryServer):
     def _get_landing_redirection_target(self) -> str:
         return "player"
 
+    def _get_library(self) -> Library | None:
+        return self.theater.library
+
+    def on_library_changed(self, keys: set[str]):
+        LibraryServer.on_library_changed(self, keys)
+        self.theater.refresh_library(keys)
+
+    def _get_folder_validators(self, relpath: pathlib.Path) -> tuple[str, datetime.datetime] | None:
+        # Pages include the watch progress, which changes independently of the
+        # library folders
+        return None
+
+    def _get_media(self, relpath: pathlib.Path) -> Media | None:
+        return self.theater.library.get_media(relpath)
+
     def _get_library_folder(self, relpath: pathlib.Path) -> LibraryFolder | None:
         folder_path = relpath.parent if relpath.name in {"index.html", "index.json"} else relpath
         try:
@@ -454,8 +779,7 @@ class PlayerServer(LibraryServer):
         queue_index = [int(x) for x in queue_arg.split(",") if x]
         seek = int(query_get(query, "seek", "0"))
         self.theater.load_and_play(path, seek, target, queue_index)
-        if target == "next":
-            self.wss._broadcast("QUEU")
+        self.wss.sync.update("player", "queue")
         return werkzeug.Response("OK", status=204, mimetype="text/plain")
 
     def _media_from_query_path(self, query: dict[str, None | str | list[str]]) -> Media | None:
@@ -495,11 +819,13 @@ class PlayerServer(LibraryServer):
         text = json.dumps(media_details)
         return werkzeug.Response(text, status=200, mimetype="application/json")
 
-    def view_api_player(self, request: werkzeug.Request) -> werkzeug.Response:
-        data = {
+    def get_player_state(self) -> dict:
+        """Return the state of the player, except for its time, which is
+        broadcast separately.
+        """
+        return {
             "mediaPath": self.theater.player.media_path,
             "state": self.theater.player.state,
-            "time": self.theater.player.time,
             "audio": self.theater.player.selected_audio_source,
             "subs": self.theater.player.selected_subtitle_source,
             "volume": self.theater.player.current_volume,
@@ -510,11 +836,26 @@ class PlayerServer(LibraryServer):
             "sleepAt": self.wss.sleep_at,
             "aspectRatio": self.theater.player.current_aspect_ratio,
         }
+
+    def get_media_state(self) -> dict | None:
+        media = self.theater.player.media
+        return None if media is None else media.to_fulldict()
+
+    def view_api_player(self, request: werkzeug.Request) -> werkzeug.Response:
+        data = {
+            **self.get_player_state(),
+            "time": self.theater.player.time,
+        }
         text = json.dumps(data)
         return werkzeug.Response(text, status=200, mimetype="application/json")
 
     def view_api_queue(self, request: werkzeug.Request) -> werkzeug.Response:
-        data = self.theater.queue.to_dict()
+        query = parse_qs(request.url)
+        offset = query_get(query, "offset", "")
+        limit = query_get(query, "limit", "")
+        data = self.theater.queue.to_dict(
+            int(offset) if offset else None,
+            int(limit) if limit else None)
         text = json.dumps(data)
         return werkzeug.Response(text, status=200, mimetype="application/json")
 
@@ -542,6 +883,7 @@ class PlayerServer(LibraryServer):
         status = self.read_status()
         if status is not None:
             self.theater.load_status_dict(status)
+            self.wss.sync.update(*TOPICS)
         return werkzeug.Response("OK", status=204, mimetype="text/plain")
 
     def view_api_export_status(self, request: werkzeug.Request) -> werkzeug.Response:
@@ -559,6 +901,8 @@ class PlayerServer(LibraryServer):
         return werkzeug.Response("200 OK", status=200, mimetype="text/plain")
 
     def view_api_wss(self, request: werkzeug.Request) -> werkzeug.Response:
+        if self.settings.server_backend == "asyncio":
+            return werkzeug.Response(f"ws://{request.host}{WEBSOCKET_PATH}", status=200, mimetype="text/plain")
         return werkzeug.Response(f"ws://{self.wss.host}:{self.wss.port}", status=200, mimetype="text/plain")
 
     def dispatch_request(self, request: werkzeug.Request) -> werkzeug.Response:
@@ -611,8 +955,9 @@ def create_app(settings: Settings, with_static: bool = True):
             app.wsgi_app,
             {
                 '/static': str(BASEDIR / "static"),
-                '/media': str(pathlib.Path(settings.library_root)) if settings.library_mode == "local" else "",
             })
+    if settings.compression:
+        app.wsgi_app = CompressionMiddleware(app.wsgi_app, settings, BASEDIR / "static" if with_static else None)
     return app
 
 
@@ -626,12 +971,19 @@ def execute_hook(path: str):
 
 def runserver(settings: Settings, debug: bool = False, show_qrcode: bool = False):
     app = create_app(settings)
-    logger.info("Starting Werkzeug development server at %s:%d", settings.server_host, settings.server_port)
     if show_qrcode:
         qr = qrcode.QRCode()
         qr.add_data(f"http://{settings.server_host}:{settings.server_port}")
         qr.print_ascii()
     print(f"Server is up at http://{settings.server_host}:{settings.server_port}, press ^C to quit")
+    if settings.server_backend == "asyncio":
+        if debug:
+            logger.warning("The debugger and the reloader are only available with the werkzeug backend")
+        logger.info("Starting asyncio server at %s:%d", settings.server_host, settings.server_port)
+        server = AsyncioServer(app, settings, app.wss if isinstance(app, PlayerServer) else None)
+        server.run()
+        return
+    logger.info("Starting Werkzeug development server at %s:%d", settings.server_host, settings.server_port)
     werkzeug.serving.run_simple(
         settings.server_host, settings.server_port,
         app,
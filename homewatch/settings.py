@@ -70,6 +70,14 @@ def sget_setstr(*args, **kwargs) -> set[str]:
     return set(value)
 
 
+def sget_listint(*args, **kwargs) -> list[int]:
+    value = sget(*args, **kwargs)
+    assert isinstance(value, list)
+    for x in value:
+        assert isinstance(x, int)
+    return value
+
+
 def sget_bool(*args, **kwargs) -> bool:
     value = sget(*args, **kwargs)
     assert isinstance(value, bool)
@@ -84,8 +92,8 @@ def sget_int(*args, **kwargs) -> int:
 
 def sget_float(*args, **kwargs) -> float:
     value = sget(*args, **kwargs)
-    assert isinstance(value, float)
-    return value
+    assert isinstance(value, (int, float)) and not isinstance(value, bool)
+    return float(value)
 
 
 def guess_local_ip() -> str:
@@ -102,10 +110,13 @@ class Settings:
     server_mode: Literal["library"] | Literal["player"]
     server_host: str
     server_port: int
+    server_backend: Literal["werkzeug"] | Literal["asyncio"]
+    server_workers: int
 
     home_url: str
     static_url: str
     media_url: str
+    thumbnail_url: str
 
     pre_hooks: list[str]
     post_hooks: list[str]
@@ -116,16 +127,41 @@ class Settings:
     subtitle_exts: set[str]
     playlist_exts: set[str]
     hidden_directory: str
+    metadata_path: str | None
     thumbnail_width: int
     thumbnail_height: int
+    thumbnail_densities: list[int]
+    thumbnail_formats: list[str]
+    lazy_thumbnails: bool
+    thumbnail_timeout_seconds: float
+    trickplay: bool
+    trickplay_interval_seconds: int
+    trickplay_columns: int
+    trickplay_width: int
+    trickplay_height: int
+    scan_jobs: int
+    incremental_scan: bool
+    library_watch: bool
+    library_watch_debounce_seconds: int
+    library_watch_poll_seconds: int
+    remote_fetch_jobs: int
+    folder_cache_size: int
+    folder_cache_ttl_seconds: int
+    hierarchy_cache_ttl_seconds: int
+    compression: bool
+    compression_min_bytes: int
     chromecast_generation: ChromecastGeneration
     mark_as_viewed_threshold_seconds: float
     mark_as_viewed_threshold_ratio: float
 
 
     vlc_dll_directory: str | None
+    history_backend: Literal["json"] | Literal["sqlite"]
     history_path: str
+    history_database_path: str
+    history_flush_interval_seconds: float
     status_path: str
+    library_snapshot_path: str | None
 
     show_waiting_screen_at_startup: bool
     waiting_screen_volume: int
@@ -139,8 +175,10 @@ class Settings:
     default_subs_delay_step_milliseconds: int
     default_volume: int
     default_aspect_ratio: str | None
+    queue_window_size: int
     preferred_media_language: str
-    broadcast_time_delay_milliseconds: int
+    time_anchor_interval_seconds: int
+    time_anchor_tolerance_milliseconds: int
 
     geckodriver_path: Path
     firefox_path: Path
@@ -156,13 +194,20 @@ class Settings:
         library_root = sget_str(data, "library_root")
         if library_mode == "local":
             library_root = str(Path(library_root).absolute())
+        thumbnail_formats = sget_liststr(data, "thumbnail_formats")
+        for thumbnail_format in thumbnail_formats:
+            if thumbnail_format not in ("webp", "avif"):
+                raise ValueError(f"Invalid thumbnail format '{thumbnail_format}', expected one of 'webp', 'avif'")
         return cls(
             server_mode=sget(data, "server_mode", assert_in=["library", "player"]), # type: ignore
             server_host=sget_str(data, "server_host", default=guess_local_ip(), empty_is_none=True, none_is_default=True),
             server_port=sget_int(data, "server_port"),
+            server_backend=sget(data, "server_backend", assert_in=["werkzeug", "asyncio"]), # type: ignore
+            server_workers=max(1, sget_int(data, "server_workers")),
             home_url=sget_str(data, "home_url"),
             static_url=sget_str(data, "static_url"),
             media_url=sget_str(data, "media_url"),
+            thumbnail_url=sget_str(data, "thumbnail_url"),
             pre_hooks=sget_liststr(data, "pre_hooks"),
             post_hooks=sget_liststr(data, "post_hooks"),
             library_mode=library_mode, # type: ignore
@@ -171,14 +216,39 @@ class Settings:
             subtitle_exts=sget_setstr(data, "subtitle_exts"),
             playlist_exts=sget_setstr(data, "playlist_exts"),
             hidden_directory=sget_str(data, "hidden_directory"),
+            metadata_path=sget(data, "metadata_path", empty_is_none=True),
             thumbnail_width=sget_int(data, "thumbnail_width"),
             thumbnail_height=sget_int(data, "thumbnail_height"),
+            thumbnail_densities=sorted(set(sget_listint(data, "thumbnail_densities")) | {1}),
+            thumbnail_formats=thumbnail_formats,
+            lazy_thumbnails=sget_bool(data, "lazy_thumbnails"),
+            thumbnail_timeout_seconds=sget_float(data, "thumbnail_timeout_seconds"),
+            trickplay=sget_bool(data, "trickplay"),
+            trickplay_interval_seconds=max(1, sget_int(data, "trickplay_interval_seconds")),
+            trickplay_columns=max(1, sget_int(data, "trickplay_columns")),
+            trickplay_width=sget_int(data, "trickplay_width"),
+            trickplay_height=sget_int(data, "trickplay_height"),
+            scan_jobs=max(1, sget_int(data, "scan_jobs")),
+            incremental_scan=sget_bool(data, "incremental_scan"),
+            library_watch=sget_bool(data, "library_watch"),
+            library_watch_debounce_seconds=sget_int(data, "library_watch_debounce_seconds"),
+            library_watch_poll_seconds=sget_int(data, "library_watch_poll_seconds"),
+            remote_fetch_jobs=max(1, sget_int(data, "remote_fetch_jobs")),
+            folder_cache_size=sget_int(data, "folder_cache_size"),
+            folder_cache_ttl_seconds=sget_int(data, "folder_cache_ttl_seconds"),
+            hierarchy_cache_ttl_seconds=sget_int(data, "hierarchy_cache_ttl_seconds"),
+            compression=sget_bool(data, "compression"),
+            compression_min_bytes=sget_int(data, "compression_min_bytes"),
             chromecast_generation=ChromecastGeneration(sget_int(data, "chromecast_generation")),
             mark_as_viewed_threshold_seconds=sget_int(data, "mark_as_viewed_threshold_seconds"),
             mark_as_viewed_threshold_ratio=sget_float(data, "mark_as_viewed_threshold_ratio"),
             vlc_dll_directory=sget(data, "vlc_dll_directory", empty_is_none=True),
+            history_backend=sget(data, "history_backend", assert_in=["json", "sqlite"]), # type: ignore
             history_path=sget_str(data, "history_path"),
+            history_database_path=sget_str(data, "history_database_path"),
+            history_flush_interval_seconds=max(0, sget_float(data, "history_flush_interval_seconds")),
             status_path=sget_str(data, "status_path"),
+            library_snapshot_path=sget(data, "library_snapshot_path", empty_is_none=True),
             show_waiting_screen_at_startup=sget_bool(data, "show_waiting_screen_at_startup"),
             waiting_screen_volume=sget_int(data, "waiting_screen_volume"),
             default_autoplay=sget_bool(data, "default_autoplay"),
@@ -190,8 +260,10 @@ class Settings:
             default_subs_delay_step_milliseconds=sget_int(data, "default_subs_delay_step_milliseconds"),
             default_volume=sget_int(data, "default_volume"),
             default_aspect_ratio=sget(data, "default_aspect_ratio", empty_is_none=True),
+            queue_window_size=max(1, sget_int(data, "queue_window_size")),
             preferred_media_language=sget(data, "preferred_media_language", assert_in=["fr", "en"]), # type: ignore
-            broadcast_time_delay_milliseconds=sget_int(data, "broadcast_time_delay_milliseconds"),
+            time_anchor_interval_seconds=sget_int(data, "time_anchor_interval_seconds"),
+            time_anchor_tolerance_milliseconds=sget_int(data, "time_anchor_tolerance_milliseconds"),
             geckodriver_path=Path(sget_str(data, "geckodriver_path", default="geckodriver.exe" if sys.platform == "win32" else "geckodriver", empty_is_none=True, none_is_default=True)),
             firefox_path=Path(sget_str(data, "firefox_path", default="C:\\Program Files\\Mozilla Firefox\\firefox.exe" if sys.platform == "win32" else "/usr/bin/firefox", empty_is_none=True, none_is_default=True)),
             addons_dir=Path(sget_str(data, "addons_dir")),
@@ -0,0 +1,80 @@
+"""Snapshot of the whole library, so that the player can start without scanning
+or fetching it first.
+
+The file starts with a magic number and a format version, followed by the
+zlib-compressed JSON dump of the library and of its folder fingerprints.
+Snapshots with another version, or taken from another library root, are
+ignored.
+"""
+
+import json
+import logging
+import os
+import pathlib
+import struct
+import zlib
+
+from .library import Library
+from .settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+
+SNAPSHOT_MAGIC = b"HWLS"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct(">4sH")
+
+
+def write_library_snapshot(library: Library, path: str | pathlib.Path):
+    """Write the snapshot atomically, so that a crash while writing it leaves
+    the previous one intact.
+    """
+    data = {
+        "mode": library.settings.library_mode,
+        "root": library.settings.library_root,
+        "library": library.to_dict(),
+        "fingerprints": {
+            key: folder.fingerprint
+            for key, folder in library.items()
+            if folder.fingerprint is not None
+        },
+    }
+    payload = zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf8"), 6)
+    path = pathlib.Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("wb") as file:
+        file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION))
+        file.write(payload)
+    os.replace(tmp_path, path)
+    logger.info("Wrote library snapshot to %s (%d bytes)", path, SNAPSHOT_HEADER.size + len(payload))
+
+
+def read_library_snapshot(settings: Settings, path: str | pathlib.Path) -> Library | None:
+    """Return the library stored in the snapshot at `path`, or None if there
+    is no usable snapshot.
+    """
+    path = pathlib.Path(path)
+    if not path.is_file():
+        return None
+    try:
+        with path.open("rb") as file:
+            raw = file.read()
+        magic, version = SNAPSHOT_HEADER.unpack_from(raw)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            logger.info("Ignoring library snapshot at %s: unsupported format", path)
+            return None
+        data = json.loads(zlib.decompress(raw[SNAPSHOT_HEADER.size:]).decode("utf8"))
+    except (OSError, struct.error, zlib.error, ValueError) as err:
+        logger.warning("Could not read library snapshot at %s: %s", path, err)
+        return None
+    if data["mode"] != settings.library_mode or data["root"] != settings.library_root:
+        logger.info("Ignoring library snapshot at %s: it was taken from another library", path)
+        return None
+    library = Library.from_dict(settings, data["library"])
+    library.root = pathlib.Path(settings.library_root) if settings.library_mode == "local" else settings.library_root
+    for key, fingerprint in data["fingerprints"].items():
+        if key in library:
+            library[key].fingerprint = fingerprint
+    logger.info("Loaded library snapshot from %s (%d folders)", path, len(library))
+    return library
@@ -78,7 +78,8 @@ function parseSubfiles(mediaElement) {
 function showMediaDetails(mediaElement) {
     const template = document.getElementById("template-media-details");
     const detailsElement =  document.importNode(template.content, true);
-    detailsElement.querySelector(".modal-background").src = mediaElement.querySelector(".media-poster").src;
+    const poster = mediaElement.querySelector(".media-poster");
+    detailsElement.querySelector(".modal-background").src = poster.currentSrc || poster.src;
     detailsElement.querySelector(".title").innerHTML = mediaElement.querySelector(".title").innerHTML;
     detailsElement.querySelector(".subtitle").innerHTML = mediaElement.querySelector(".subtitle").innerHTML;
     detailsElement.querySelector(".media-details-url").href = mediaElement.getAttribute("href");
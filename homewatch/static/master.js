@@ -136,11 +136,12 @@ if (linkWaitingScreen != null) {
 
 class WebsocketClient {
 
-    constructor(apiUrl, onMessage) {
+    constructor(apiUrl, onMessage, onOpen=null) {
         this.apiUrl = apiUrl;
         this.websocket = null;
         this.retryCount = 0;
         this.onMessage = onMessage;
+        this.onOpen = onOpen;
         this.connected = false;
     }
 
@@ -160,6 +161,9 @@ class WebsocketClient {
             document.body.classList.remove("wss-disconnected");
             document.body.classList.add("wss-connected");
             self.connected = true;
+            if (self.onOpen != null) {
+                self.onOpen();
+            }
         }
         this.websocket.onmessage = (message) => {
             //console.debug("WSS data:", message.data);
@@ -15,29 +15,105 @@ const STATE_ERROR = 7;
  * Websocket logic
  */
 
+/**
+ * State of the player, the queue and the current media, synchronized with
+ * the server: a snapshot is received when subscribing to a topic, then diffs
+ * that each apply to the previous version.
+ */
+const SYNC_TOPICS = ["player", "queue", "media"];
+const syncedState = {};
+
+function subscribe(topics) {
+    wssClient.send(`SUBS ${topics.join(",")}`);
+}
+
+function applySyncedState(topic) {
+    const state = syncedState[topic].state;
+    switch(topic) {
+        case "player":
+            player.loadPlayerData(state);
+            break;
+        case "queue":
+            player.setQueue(state);
+            break;
+        case "media":
+            if (state != null) player.setMedia(state);
+            break;
+    }
+}
+
+function onSnapshot(data) {
+    syncedState[data.topic] = {version: data.version, state: data.state};
+    applySyncedState(data.topic);
+}
+
+function onDiff(data) {
+    const synced = syncedState[data.topic];
+    if (synced == undefined || data.version != synced.version + 1) {
+        console.log("Missed an update of", data.topic, ", subscribing again");
+        delete syncedState[data.topic];
+        subscribe([data.topic]);
+        return;
+    }
+    synced.version = data.version;
+    if ("changes" in data) {
+        synced.state = {...synced.state, ...data.changes};
+    } else {
+        synced.state = data.state;
+    }
+    applySyncedState(data.topic);
+}
+
+/**
+ * The playback time is interpolated from the anchors sent by the server on
+ * state changes, seeks and at a slow interval. Anchors are dated with the time
+ * they are received, so that clocks do not need to be synchronized.
+ */
+var timeAnchor = null;
+var timeAnchorTimeout = null;
+
+function setTimeAnchor(anchor) {
+    timeAnchor = {time: anchor.time, rate: anchor.rate, receivedAt: performance.now()};
+    updateInterpolatedTime();
+}
+
+function getInterpolatedTime() {
+    if (timeAnchor == null) return null;
+    let timeMs = timeAnchor.time + (performance.now() - timeAnchor.receivedAt) * timeAnchor.rate;
+    if (player.media != null) {
+        timeMs = Math.min(timeMs, player.media.duration * 1000);
+    }
+    return Math.round(timeMs);
+}
+
+function updateInterpolatedTime() {
+    clearTimeout(timeAnchorTimeout);
+    const timeMs = getInterpolatedTime();
+    if (timeMs == null) return;
+    player.setTime(timeMs, false);
+    if (timeAnchor.rate > 0) {
+        // Wake up when the displayed second changes
+        const delay = (1000 - timeMs % 1000) / timeAnchor.rate;
+        timeAnchorTimeout = setTimeout(updateInterpolatedTime, delay + 5);
+    }
+}
+
 const wssClient = new WebsocketClient(API_URL, (message) => {
     const key = message.slice(0, 4);
     const value = message.slice(5);
     switch(key) {
-        case "TIME":
-            player.setTime(parseInt(value), false);
+        case "ANCH":
+            setTimeAnchor(JSON.parse(value));
             break;
-        case "MPTH":
-            player.setMediaPath(value);
-            fetch(`${API_URL}/player`).then(res =>  res.json()).then(data => {
-                player.loadPlayerData(data, true);
-            });
-            break;
-        case "MSTT":
-            player.setState(parseInt(value));
+        case "SNAP":
+            onSnapshot(JSON.parse(value));
             break;
-        case "QUEU":
-            player.fetchQueue();
-            break;
-        case "SDEL":
-            player.setSubtitlesDelay(parseInt(value));
+        case "DIFF":
+            onDiff(JSON.parse(value));
             break;
     }
+}, () => {
+    subscribe(SYNC_TOPICS);
 });
 wssClient.connect();
 
@@ -130,13 +206,9 @@ class Player {
         this.queue = null;
     }
 
-    loadPlayerData(playerData, skipMediaPath=false) {
-        console.log("loading player data", playerData);
-        if (!skipMediaPath) {
-            this.setMediaPath(playerData.mediaPath);
-        }
+    loadPlayerData(playerData) {
+        this.setMediaPath(playerData.mediaPath);
         this.setState(playerData.state);
-        this.setTime(playerData.time, false);
         this.setAudio(playerData.audio, false);
         this.setSubs(playerData.subs, false);
         this.setVolume(playerData.volume);
@@ -148,23 +220,6 @@ class Player {
         this.setAspectRatio(playerData.aspectRatio, false);
     }
 
-    fetchMedia() {
-        if (this.mediaPath == null) return;
-        fetch(`${API_URL}/media?path=${this.mediaPath.replaceAll("&", "%26")}`)
-            .then(res => res.json())
-            .then(data => {
-                this.setMedia(data);
-            });
-    }
-
-    fetchQueue() {
-        fetch(`${API_URL}/queue`)
-            .then(res => res.json())
-            .then(data => {
-                this.setQueue(data);
-            });
-    }
-
     setMediaPath(newMediaPath) {
         if (newMediaPath == "None") newMediaPath = null;
         if (newMediaPath != null && this.mediaPath == null) {
@@ -173,18 +228,17 @@ class Player {
         if (this.mediaPath == newMediaPath) return;
         console.log("Setting new media path to", newMediaPath, "Old is", this.mediaPath);
         this.mediaPath = newMediaPath;
-        this.fetchMedia();
-        this.fetchQueue();
     }
 
     setMedia(newMedia) {
         console.log("Setting media:", newMedia);
         var self = this;
         this.media = newMedia;
-        const thumbnailUrl = MEDIA_URL + this.media.folder + "/" + this.media.thumbnail;
+        const thumbnailUrl = THUMBNAIL_URL + this.media.folder + "/" + this.media.basename;
         document.querySelector(".player-left img").src = thumbnailUrl;
         document.querySelector(".player-left .title").textContent = this.media.title;
         inflateMediaSubtitle(this.media, document.querySelector(".player-left .subtitle"));
+        loadTrickplay(this.media);
         document.querySelectorAll(".timebar-input").forEach(input => {
             input.max = this.media.duration * 1000;
         });
@@ -208,10 +262,13 @@ class Player {
         const container = document.getElementById("queue");
         const template = document.getElementById("template-queue-media");
         container.innerHTML = "";
-        for (let i = 0; i < this.queue.elements.length; i++) {
-            const media = this.queue.elements[this.queue.ordering[i]];
+        // Only a window of the queue around the current element is sent,
+        // starting at position `offset`
+        for (let j = 0; j < this.queue.elements.length; j++) {
+            const i = this.queue.offset + j;
+            const media = this.queue.elements[j];
             const element = document.importNode(template.content, true);
-            const thumbnailUrl = MEDIA_URL + media.folder + "/" + media.thumbnail;
+            const thumbnailUrl = THUMBNAIL_URL + media.folder + "/" + media.basename;
             element.querySelector(".inline-media-poster").src = thumbnailUrl;
             element.querySelector(".title").textContent = media.title;
             element.querySelector(".subtitle").textContent = media.subtitle;
@@ -239,6 +296,11 @@ class Player {
         }
         if (notify) {
             wssClient.send(`SEEK ${this.time}`);
+            if (timeAnchor != null) {
+                // Until the server sends the new anchor
+                timeAnchor.time = this.time;
+                timeAnchor.receivedAt = performance.now();
+            }
         }
     }
 
@@ -316,7 +378,6 @@ class Player {
         if (notify) {
             wssClient.send(`SHUF ${this.shuffle ? "1" : "0"}`);
         }
-        this.fetchQueue();
     }
 
     setCloseOnEnd(newCloseOnEnd, notify=true) {
@@ -351,10 +412,6 @@ setInterval(displaySleepAt, 1000);
 
 var player = new Player();
 
-fetch(`${API_URL}/player`).then(res =>  res.json()).then(data => {
-    player.loadPlayerData(data);
-});
-
 function closePreviousStatus() {
     document.querySelectorAll(".modal-previous-status").forEach(remove);
 }
@@ -362,7 +419,7 @@ function closePreviousStatus() {
 function askUserForLoadingPreviousStatus(status) {
     const template = document.getElementById("template-previous-status");
     const node =  document.importNode(template.content, true);
-    node.querySelector(".poster").src = MEDIA_URL + status.player.media.folder + "/" + status.player.media.thumbnail;
+    node.querySelector(".poster").src = THUMBNAIL_URL + status.player.media.folder + "/" + status.player.media.basename;
     node.querySelector(".title").textContent = status.player.media.title;
     node.querySelector(".subtitle").textContent = status.player.media.subtitle;
     node.querySelector(".time").textContent = formatDuration(status.player.time / 1000);
@@ -389,8 +446,10 @@ if (FIRST_LIBRARY_LOAD) {
  */
 
 window.addEventListener("focus", () => {
-    wssClient.send("MEDI");
-    player.fetchQueue();
+    // Updates may have been missed while the page was in the background
+    if (wssClient.connected) {
+        subscribe(SYNC_TOPICS);
+    }
 });
 
 function bindButton(buttonId, callback) {
@@ -505,6 +564,56 @@ function displayTime(timeMs) {
     });
 }
 
+/**
+ * Seek previews, read from the WebVTT index of the media sprite sheet.
+ * Cues are {start, end, url, x, y, w, h}, with times in seconds.
+ */
+var trickplay = null;
+
+function parseVttTimestamp(string) {
+    return string.split(":").reduce((total, part) => total * 60 + parseFloat(part), 0);
+}
+
+function loadTrickplay(media) {
+    trickplay = null;
+    if (media.trickplay == null) return;
+    const vttUrl = new URL(MEDIA_URL + media.folder + "/" + media.trickplay, window.location.href);
+    fetch(vttUrl).then(res => res.text()).then(text => {
+        const cues = [];
+        for (const block of text.split(/\r?\n\r?\n/)) {
+            const lines = block.trim().split(/\r?\n/);
+            const i = lines.findIndex(line => line.includes("-->"));
+            if (i < 0 || i + 1 >= lines.length || !lines[i + 1].includes("#xywh=")) continue;
+            const [start, end] = lines[i].split("-->").map(x => parseVttTimestamp(x.trim()));
+            const [file, fragment] = lines[i + 1].split("#xywh=");
+            const [x, y, w, h] = fragment.split(",").map(v => parseInt(v));
+            cues.push({start, end, url: new URL(file, vttUrl).href, x, y, w, h});
+        }
+        if (player.media === media && cues.length > 0) {
+            trickplay = cues;
+        }
+    });
+}
+
+function displayTrickplay(input, timeMs) {
+    const preview = input.parentElement.querySelector(".timebar-preview");
+    if (preview == null) return;
+    if (trickplay == null || timeMs == null) {
+        preview.classList.add("hidden");
+        return;
+    }
+    const seconds = timeMs / 1000;
+    const cue = trickplay.find(c => seconds < c.end) ?? trickplay[trickplay.length - 1];
+    preview.style.width = `${cue.w}px`;
+    preview.style.height = `${cue.h}px`;
+    preview.style.backgroundImage = `url("${cue.url}")`;
+    preview.style.backgroundPosition = `-${cue.x}px -${cue.y}px`;
+    const ratio = input.max > 0 ? timeMs / input.max : 0;
+    const left = Math.max(0, Math.min(ratio * input.offsetWidth - cue.w / 2, input.offsetWidth - cue.w));
+    preview.style.left = `${left}px`;
+    preview.classList.remove("hidden");
+}
+
 document.querySelectorAll(".timebar-input").forEach(input => {
     input.addEventListener("pointerdown", (e) => {
         seeking = true;
@@ -512,12 +621,19 @@ document.querySelectorAll(".timebar-input").forEach(input => {
     input.addEventListener("pointermove", (e) => {
         if (seeking) {
             displayTime(parseInt(input.value));
+            displayTrickplay(input, parseInt(input.value));
         }
     });
     input.addEventListener("pointerup", (e) => {
         seeking = false;
+        displayTrickplay(input, null);
         player.setTime(parseInt(input.value));
     });
+    input.addEventListener("pointercancel", (e) => {
+        seeking = false;
+        displayTrickplay(input, null);
+        displayTime(player.time);
+    });
 });
 
 bindButton("button-prev", () => { wssClient.send("PREV"); });
@@ -0,0 +1,112 @@
+"""Serving of media files, with support for HTTP range requests.
+
+Files are transferred with the server's `wsgi.file_wrapper` when it provides
+one, which lets servers such as mod_wsgi use `sendfile` and avoid copying the
+data through Python. Otherwise, they are read in large chunks, after hinting
+the kernel that they are read sequentially.
+"""
+
+import datetime
+import logging
+import os
+import pathlib
+from typing import BinaryIO, Iterator
+
+import werkzeug
+import werkzeug.http
+
+
+logger = logging.getLogger(__name__)
+
+
+CHUNK_SIZE = 256 * 1024
+
+
+def advise_sequential(file: BinaryIO, start: int, length: int):
+    """Tell the kernel the range will be read sequentially, and to start
+    reading it ahead. Not available on every platform.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(file.fileno(), start, length, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(file.fileno(), start, min(length, 4 * CHUNK_SIZE), os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+
+
+def iter_file_range(file: BinaryIO, start: int, stop: int) -> Iterator[bytes]:
+    """Yield the bytes of `file` from `start` to `stop` (excluded), and close
+    it once done or when the response is closed early.
+    """
+    try:
+        file.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = file.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        file.close()
+
+
+def get_file_etag(stat: os.stat_result) -> str:
+    return f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+
+def is_range_applicable(environ: dict, etag: str, last_modified: datetime.datetime) -> bool:
+    """Check the If-Range precondition: ranges only apply if the client's copy
+    is still current.
+    """
+    if_range = werkzeug.http.parse_if_range_header(environ.get("HTTP_IF_RANGE"))
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return if_range.date == last_modified
+    return True
+
+
+def send_media_file(environ: dict, path: pathlib.Path, mimetype: str) -> werkzeug.Response:
+    try:
+        file = path.open("rb")
+    except OSError:
+        return werkzeug.Response("404 Not Found", status=404, mimetype="text/plain")
+    stat = os.fstat(file.fileno())
+    size = stat.st_size
+    etag = get_file_etag(stat)
+    last_modified = datetime.datetime.fromtimestamp(int(stat.st_mtime), datetime.timezone.utc)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": werkzeug.http.quote_etag(etag),
+        "Last-Modified": werkzeug.http.http_date(last_modified),
+    }
+    if not werkzeug.http.is_resource_modified(environ, etag=etag, last_modified=last_modified):
+        file.close()
+        return werkzeug.Response(status=304, headers=headers)
+    status = 200
+    start, stop = 0, size
+    range_header = werkzeug.http.parse_range_header(environ.get("HTTP_RANGE"))
+    if range_header is not None and len(range_header.ranges) == 1 and is_range_applicable(environ, etag, last_modified):
+        byte_range = range_header.range_for_length(size)
+        if byte_range is None:
+            file.close()
+            headers["Content-Range"] = f"bytes */{size}"
+            return werkzeug.Response("416 Range Not Satisfiable", status=416, mimetype="text/plain", headers=headers)
+        start, stop = byte_range
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    headers["Content-Length"] = str(stop - start)
+    if environ.get("REQUEST_METHOD") == "HEAD":
+        file.close()
+        return werkzeug.Response(status=status, mimetype=mimetype, headers=headers)
+    advise_sequential(file, start, stop - start)
+    file_wrapper = environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None:
+        # The server sends at most Content-Length bytes from the current offset
+        file.seek(start)
+        body = file_wrapper(file, CHUNK_SIZE)
+    else:
+        body = iter_file_range(file, start, stop)
+    return werkzeug.Response(body, status=status, mimetype=mimetype, headers=headers, direct_passthrough=True)
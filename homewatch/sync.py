@@ -0,0 +1,102 @@
+"""Versioned synchronization of the player state with websocket clients.
+
+The state is split into topics ('player', 'queue' and 'media'). Clients
+subscribe to topics with `SUBS <topic>,<topic>…` and receive a snapshot of
+each one:
+
+    SNAP {"topic": "player", "version": 12, "state": {...}}
+
+Whenever a topic changes, subscribers only receive the top-level keys whose
+value changed (removed keys are set to null), or the whole state if it is not
+an object:
+
+    DIFF {"topic": "player", "version": 13, "changes": {"volume": 80}}
+    DIFF {"topic": "media", "version": 4, "state": null}
+
+A diff applies to the previous version only. Clients that missed a version
+subscribe again to get a new snapshot.
+"""
+
+import json
+import logging
+import threading
+from typing import Any, Callable, Hashable
+
+
+logger = logging.getLogger(__name__)
+
+
+TOPICS = ("player", "queue", "media")
+
+
+def diff_states(old: dict, new: dict) -> dict:
+    changes = {key: value for key, value in new.items() if key not in old or old[key] != value}
+    for key in old:
+        if key not in new:
+            changes[key] = None
+    return changes
+
+
+class StateSync:
+    """
+    @param providers: functions returning the current state of each topic
+    @param send: function sending a message to the clients with the given
+        keys, from any thread, preserving the order of the calls
+    """
+
+    def __init__(self, providers: dict[str, Callable[[], Any]], send: Callable[[list[Hashable], str], None]):
+        self.providers = providers
+        self.send = send
+        self._lock = threading.Lock()
+        self._states: dict[str, Any] = {}
+        self._versions: dict[str, int] = {topic: 0 for topic in providers}
+        self._subscribers: dict[str, set[Hashable]] = {topic: set() for topic in providers}
+
+    def subscribe(self, client: Hashable, topics: list[str]):
+        """Subscribe a client to topics, and send it their snapshots.
+        """
+        with self._lock:
+            for topic in topics:
+                if topic not in self.providers:
+                    logger.debug("Ignoring subscription to unknown topic %s", topic)
+                    continue
+                if topic not in self._states:
+                    self._states[topic] = self.providers[topic]()
+                else:
+                    # Make sure the snapshot is current, and that other
+                    # subscribers get the same version
+                    self._refresh(topic)
+                self._subscribers[topic].add(client)
+                self.send([client], "SNAP " + json.dumps({
+                    "topic": topic,
+                    "version": self._versions[topic],
+                    "state": self._states[topic],
+                }))
+
+    def unsubscribe(self, client: Hashable):
+        with self._lock:
+            for subscribers in self._subscribers.values():
+                subscribers.discard(client)
+
+    def update(self, *topics: str):
+        """Read the current state of the topics again, and send what changed to
+        their subscribers.
+        """
+        with self._lock:
+            for topic in topics:
+                if topic in self._states:
+                    self._refresh(topic)
+
+    def _refresh(self, topic: str):
+        old, new = self._states[topic], self.providers[topic]()
+        if old == new:
+            return
+        self._states[topic] = new
+        self._versions[topic] += 1
+        payload: dict[str, Any] = {"topic": topic, "version": self._versions[topic]}
+        if isinstance(old, dict) and isinstance(new, dict):
+            payload["changes"] = diff_states(old, new)
+        else:
+            payload["state"] = new
+        if self._subscribers[topic]:
+            self.send(list(self._subscribers[topic]), "DIFF " + json.dumps(payload))
@@ -4,10 +4,13 @@ import threading
 import time
 
 from .player import Player, PlayerObserver
-from .history import History
+from .history import History, SqliteHistory, create_history
 from .library import Library, LibraryFolder, Media
+from .metadata import MetadataStore
+from .progress import ProgressTree, is_media_done
 from .queue import Queue, StartOfQueueException, EndOfQueueException
 from .settings import Settings
+from .snapshot import read_library_snapshot, write_library_snapshot
 
 
 logger = logging.getLogger(__name__)
@@ -18,14 +21,25 @@ class Theater(PlayerObserver):
     def __init__(self, settings: Settings):
         PlayerObserver.__init__(self)
         self.settings = settings
-        self.library: Library = Library.from_settings(settings)
+        self._library_lock = threading.Lock()
+        snapshot = None
+        if settings.library_snapshot_path is not None:
+            snapshot = read_library_snapshot(settings, settings.library_snapshot_path)
+        self.library: Library = Library.from_settings(settings) if snapshot is None else snapshot
         self.player: Player = Player(settings)
-        self.history: History = History(settings.history_path)
-        self.queue: Queue = Queue(settings.default_shuffle, settings.default_loop)
+        self.history: History | SqliteHistory = create_history(settings)
+        self.progress = ProgressTree(settings)
+        self.apply_library_moves()
+        self.progress.build(self.library, self.history)
+        self.queue: Queue = Queue(settings.default_shuffle, settings.default_loop, settings.queue_window_size)
         self.player.setup()
         self.player.bind_observer(self)
         self.autoplay = settings.default_autoplay
         self.waiting_screen_visible: bool = False
+        if snapshot is None:
+            self.save_library_snapshot()
+        else:
+            threading.Thread(target=self.reload_library, daemon=True).start()
 
     def load_current(self):
         media = self.queue.current_media
@@ -38,9 +52,14 @@ class Theater(PlayerObserver):
         if self.queue.current_media is None:
             return
         if new_time is not None and new_time >= 0 and not self.waiting_screen_visible:
-            self.history.update(self.queue.current_media, new_time)
+            self.set_media_progress(self.queue.current_media, new_time)
+
+    def on_media_changed(self, media_path: str | None):
+        self.history.flush()
 
     def on_media_state_changed(self, new_state: int | None):
+        if new_state in (Player.STATE_STOPPED, Player.STATE_ENDED):
+            self.history.flush()
         if new_state == Player.STATE_ENDED and self.waiting_screen_visible:
             def callback():
                 time.sleep(.1)
@@ -123,38 +142,93 @@ class Theater(PlayerObserver):
         except EndOfQueueException:
             pass
 
+    def refresh_library(self, keys: set[str]):
+        """
+        @param keys: paths of the changed folders, relative to the library root
+        """
+        with self._library_lock:
+            # Request threads read the library without the lock: the new one is
+            # built aside, then swapped in
+            self.library = self.library.refresh_folders(keys)
+            self.queue.resolve_elements(self.library)
+            self.apply_library_moves()
+            self.progress.refresh(self.library, keys, self.history)
+        self.save_library_snapshot()
+
+    def reload_library(self):
+        """Scan or fetch the whole library again and replace the current one.
+        Unchanged folders of a local library are reused.
+        """
+        logger.info("Reloading library in the background")
+        try:
+            with self._library_lock:
+                if self.settings.library_mode == "local":
+                    self.library = Library.from_scan(self.settings, previous=self.library)
+                else:
+                    self.library = Library.from_settings(self.settings)
+                # Medias of the previous library may have been replaced
+                self.queue.resolve_elements(self.library)
+                self.apply_library_moves()
+                self.progress.build(self.library, self.history)
+        except Exception as err:
+            logger.exception("Could not reload library: %s", err)
+            return
+        self.save_library_snapshot()
+
+    def save_library_snapshot(self, blocking: bool = True):
+        """
+        @param blocking: wait for the library to be updated if it is, instead of
+            skipping the snapshot
+        """
+        if self.settings.library_snapshot_path is None:
+            return
+        if not self._library_lock.acquire(blocking):
+            logger.info("Library is being updated, skipping snapshot")
+            return
+        try:
+            write_library_snapshot(self.library, self.settings.library_snapshot_path)
+        except OSError as err:
+            logger.warning("Could not write library snapshot: %s", err)
+        finally:
+            self._library_lock.release()
+
+    def apply_library_moves(self):
+        """Carry the watch progress of medias that were moved or renamed since
+        the last scan over to their new path.
+        """
+        if self.settings.library_mode != "local":
+            return
+        for old_path, new_path in MetadataStore.from_settings(self.settings).pop_moves():
+            self.history.move(old_path, new_path)
+
     def get_folder_progress(self, library_folder: LibraryFolder) -> tuple[int, int]:
-        progress, duration = 0, 0
-        for media in library_folder.medias:
-            progress += self.history[media]
-            duration += int(media.duration * 1000)
-        for subfolder in library_folder.subfolders:
-            library_subfolder = self.library.get_subfolder(library_folder, subfolder)
-            subprogress, subduration = self.get_folder_progress(library_subfolder)
-            progress += subprogress
-            duration += subduration
-        return progress, duration
+        folder_progress = self.progress.get(library_folder.path.as_posix())
+        return folder_progress.progress, folder_progress.duration
 
     def set_folder_progress(self, library_folder: LibraryFolder):
         for media in library_folder.medias:
-            progress = self.history[media]
+            progress = self.progress.get_media(media)
             setattr(media, "progress", progress)
-            done = progress > 0 and progress >= (media.duration - self.settings.mark_as_viewed_threshold_seconds) * 1000 and progress / (1000 * media.duration) >= self.settings.mark_as_viewed_threshold_ratio
             setattr(media, "unstarted", progress == 0)
-            setattr(media, "done", done)
+            setattr(media, "done", is_media_done(self.settings, progress, media.duration_ms))
         for subfolder in library_folder.subfolders:
-            progress, duration = self.get_folder_progress(self.library.get_subfolder(library_folder, subfolder))
-            setattr(subfolder, "progress", progress)
-            setattr(subfolder, "duration", duration)
-            done = progress > 0 and progress >= duration - self.settings.mark_as_viewed_threshold_seconds * 1000 and progress / duration >= self.settings.mark_as_viewed_threshold_ratio
-            setattr(subfolder, "unstarted", progress == 0)
-            setattr(subfolder, "done", done)
+            folder_progress = self.progress.get((library_folder.path / subfolder.basename).as_posix())
+            setattr(subfolder, "progress", folder_progress.progress)
+            setattr(subfolder, "duration", folder_progress.duration)
+            setattr(subfolder, "unstarted", folder_progress.is_unstarted())
+            setattr(subfolder, "done", folder_progress.is_done(self.settings))
+            setattr(subfolder, "done_medias", folder_progress.done_medias)
+            setattr(subfolder, "unstarted_medias", folder_progress.unstarted_medias)
+
+    def set_media_progress(self, media: Media, progress: int):
+        self.history.update(media, progress)
+        self.progress.update(media, progress)
 
     def set_viewed_media(self, media: Media, viewed: bool):
         if viewed:
-            self.history.update(media, media.duration_ms)
+            self.set_media_progress(media, media.duration_ms)
         else:
-            self.history.update(media, 0)
+            self.set_media_progress(media, 0)
 
     def set_viewed_folder(self, folder: LibraryFolder, viewed: bool):
         for media in folder.medias:
@@ -202,3 +276,4 @@ class Theater(PlayerObserver):
     
     def close(self):
         self.player.close()
+        self.history.close()
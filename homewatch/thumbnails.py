@@ -0,0 +1,88 @@
+"""Generation of media thumbnails on demand.
+"""
+
+import concurrent.futures
+import logging
+import pathlib
+import threading
+
+from .library import extract_thumbnail, get_thumbnail_failure_path, get_thumbnail_path
+from .settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class ThumbnailService:
+    """Extract thumbnails in a bounded pool the first time they are requested.
+    Concurrent requests for the same thumbnail share a single ffmpeg run.
+    """
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self._executor = concurrent.futures.ThreadPoolExecutor(settings.scan_jobs, "thumbnail")
+        self._pending: dict[str, concurrent.futures.Future[pathlib.Path]] = {}
+        self._lock = threading.Lock()
+
+    def _release(self, key: str):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def request(self, path: pathlib.Path, duration: float) -> concurrent.futures.Future[pathlib.Path]:
+        """Schedule the extraction of the thumbnail renditions of the media at
+        `path`, unless it is already scheduled.
+        """
+        key = path.as_posix()
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            logger.debug("Scheduling thumbnail extraction for %s", path)
+            future = self._executor.submit(
+                extract_thumbnail,
+                path,
+                self.settings.hidden_directory,
+                self.settings.thumbnail_width,
+                self.settings.thumbnail_height,
+                duration / 2,
+                self.settings.thumbnail_densities,
+                self.settings.thumbnail_formats)
+            self._pending[key] = future
+        # The callback runs right away if the extraction is already done, so
+        # it must be attached without holding the lock
+        future.add_done_callback(lambda _: self._release(key))
+        return future
+
+    def get(
+            self,
+            path: pathlib.Path,
+            duration: float,
+            timeout: float | None = None,
+            density: int = 1,
+            format: str = "jpg") -> pathlib.Path | None:
+        """Return the path to the thumbnail rendition of the media at `path`,
+        waiting at most `timeout` seconds for its extraction. Falls back to the
+        base JPEG thumbnail if the rendition could not be extracted. Returns
+        None if no thumbnail is ready yet or if the extraction failed.
+        """
+        base_path = get_thumbnail_path(path, self.settings.hidden_directory)
+        thumbnail_path = get_thumbnail_path(path, self.settings.hidden_directory, density, format)
+        if thumbnail_path.is_file():
+            return thumbnail_path
+        if base_path.is_file() and get_thumbnail_failure_path(thumbnail_path).is_file():
+            return base_path
+        future = self.request(path, duration)
+        try:
+            future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            return None
+        except Exception as err:
+            logger.warning("Could not extract thumbnail of %s: %s", path, err)
+            return None
+        for candidate in (thumbnail_path, base_path):
+            if candidate.is_file():
+                return candidate
+        return None
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,152 @@
+"""Watch the library root for changes, and report which library folders need to
+be scanned again. Uses inotify (through watchdog) when available, and falls
+back to polling directory fingerprints otherwise.
+"""
+
+import logging
+import os
+import pathlib
+import threading
+import time
+from typing import Callable
+
+from .library import walk_library
+from .settings import Settings
+
+try:
+    import watchdog.events
+    import watchdog.observers
+except ImportError:
+    watchdog = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class LibraryWatcher(threading.Thread):
+    """Collect changed folders (as paths relative to the library root) and call
+    `callback` with them once no change occurred for the debounce delay, so
+    that copying many files only triggers one update.
+    """
+
+    PERIOD_SECONDS = 1
+
+    def __init__(self, settings: Settings, callback: Callable[[set[str]], None]):
+        threading.Thread.__init__(self, daemon=True)
+        self.settings = settings
+        self.root = pathlib.Path(settings.library_root)
+        self.callback = callback
+        self.debounce_seconds = settings.library_watch_debounce_seconds
+        self.poll_seconds = settings.library_watch_poll_seconds
+        self._lock = threading.Lock()
+        self._dirty: set[str] = set()
+        self._last_change: float = 0
+        self._observer = None
+        self._fingerprints: dict[str, str] = {}
+        self._last_poll: float = 0
+
+    def _key(self, path: str | pathlib.Path) -> str | None:
+        try:
+            relpath = pathlib.Path(path).relative_to(self.root)
+        except ValueError:
+            return None
+        if self.settings.hidden_directory in relpath.parts:
+            return None
+        return relpath.as_posix()
+
+    def mark(self, path: str | pathlib.Path, is_directory: bool = False):
+        """Mark the folder containing `path` as changed, and `path` itself if
+        it is a directory. Changes within hidden directories are ignored.
+        """
+        if self._key(path) is None:
+            return
+        keys = {self._key(pathlib.Path(path).parent)}
+        if is_directory:
+            keys.add(self._key(path))
+        keys.discard(None)
+        if not keys:
+            return
+        with self._lock:
+            self._dirty.update(keys) # type: ignore
+            self._last_change = time.monotonic()
+
+    def _start_observer(self) -> bool:
+        if watchdog is None:
+            logger.info("watchdog is not installed, polling the library every %d seconds", self.poll_seconds)
+            return False
+        watcher = self
+
+        class EventHandler(watchdog.events.FileSystemEventHandler):
+
+            def on_any_event(self, event):
+                if event.event_type in ("opened", "closed_no_write"):
+                    return
+                if event.is_directory and event.event_type == "modified":
+                    # Changes of the directory contents are reported by events
+                    # on its entries
+                    return
+                watcher.mark(os.fsdecode(event.src_path), event.is_directory)
+                dest_path = getattr(event, "dest_path", "")
+                if dest_path:
+                    watcher.mark(os.fsdecode(dest_path), event.is_directory)
+
+        try:
+            self._observer = watchdog.observers.Observer()
+            self._observer.schedule(EventHandler(), str(self.root), recursive=True)
+            self._observer.start()
+        except OSError as err:
+            logger.warning("Could not watch the library (%s), falling back to polling", err)
+            self._observer = None
+            return False
+        logger.info("Watching library at %s", self.root)
+        return True
+
+    def _walk_fingerprints(self) -> dict[str, str]:
+        return {
+            listing.path.as_posix(): listing.fingerprint
+            for listing in walk_library(self.root, self.settings.hidden_directory)
+        }
+
+    def _poll(self):
+        fingerprints = self._walk_fingerprints()
+        changed = {
+            key for key in fingerprints.keys() | self._fingerprints.keys()
+            if fingerprints.get(key) != self._fingerprints.get(key)
+        }
+        self._fingerprints = fingerprints
+        if changed:
+            logger.debug("Polling found %d changed folders", len(changed))
+            with self._lock:
+                self._dirty.update(changed)
+                self._last_change = time.monotonic()
+
+    def run(self):
+        polling = not self._start_observer()
+        if polling:
+            self._fingerprints = self._walk_fingerprints()
+            self._last_poll = time.monotonic()
+        while True:
+            time.sleep(self.PERIOD_SECONDS)
+            now = time.monotonic()
+            if polling and now - self._last_poll >= self.poll_seconds:
+                self._poll()
+                self._last_poll = now
+            with self._lock:
+                if not self._dirty or now - self._last_change < self.debounce_seconds:
+                    continue
+                dirty = self._dirty
+                self._dirty = set()
+            logger.info("Library changed in %d folders", len(dirty))
+            try:
+                self.callback(dirty)
+            except Exception as err:
+                logger.exception("Error while updating the library: %s", err)
+                # Retry after the debounce delay, for instance once the files
+                # being copied are complete
+                with self._lock:
+                    self._dirty.update(dirty)
+                    self._last_change = time.monotonic()
+
+    def close(self):
+        if self._observer is not None:
+            self._observer.stop()